@@ -4,10 +4,14 @@ This script contains essential methods used to conduct experiments, simulating t
 """
 
 
-import string
-import dns.message, dns.edns, base64
+import sys, time
+import dns.message, dns.edns, dns.rcode, base64
+import httpx
 import random
+import functools
 from enum import Enum
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 
 class Methods(Enum):
@@ -15,30 +19,111 @@ class Methods(Enum):
     GET = 1
 
 
+class Browsers(Enum):
+    CHROMIUM = 0
+    FIREFOX = 1
+
+
+class Outcomes(Enum):
+    ANSWER = 0 # NOERROR with answers
+    NODATA = 1 # NOERROR without answers
+    NXDOMAIN = 2
+    SERVFAIL = 3
+    RCODE = 4 # Other DNS errors
+    MALFORMED = 5 # Not a DNS message
+    EMPTY = 6 # Empty body
+    HTTP_ERROR = 7
+    CONNECT_ERROR = 8 # Proxy, TCP or TLS failures
+    RESET = 9 # Connection closed or reset after being established
+    TIMEOUT = 10
+    ERROR = 11 # Other exceptions
+
+
 X = "YOUR_X_HERE" # The probability of using GET method for connectivity checks
 assert(X != "YOUR_X_HERE")
 
 
-def val_check(client, main_logger):
+class Liveness:
+    """Proof that the host of a session is alive, by a validity check or a DoH query answered through it, kept for ttl.
+    Random checks within ttl of the last proof are skipped, and transport failures drop the proof.
+
+    Args:
+        ttl: Time to keep the proof, in seconds.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.skipped = 0
+        self._proved_at = None
+
+    def prove(self):
+        self._proved_at = time.monotonic()
+
+    def forget(self):
+        self._proved_at = None
+
+    def alive(self):
+        """Check whether the host has been proved alive for less than ttl."""
+        return self._proved_at != None and time.monotonic() - self._proved_at <= self.ttl
+
+
+def _check_status(client, url, make_client=None):
+    """Get the status code of the page, sending an HTTP "HEAD" request with a (1- X)% probability and "GET" otherwise.
+    A "GET" goes through a client of its own, closed right after the status line and headers, instead of downloading the whole page over the residential bandwidth.
+    Closing the response alone does not stop the body over HTTP/2, as httpcore never resets the stream, while closing the client ends its connection.
+
+    Args:
+        client: HTTPX client.
+        url: The URL of the page.
+        (optional) make_client: The method to open another HTTPX client of the same proxy session, None to send "HEAD" only.
+    """
+
+    if make_client == None or random.randint(1, 100) > X:
+        with client.stream("HEAD", url) as response:
+            return response.status_code
+
+    with make_client() as get_client:
+        with get_client.stream("GET", url) as response:
+            return response.status_code
+
+
+def val_check(client, main_logger, liveness=None, make_client=None):
     """Check the validity of given host by accessing www.yahoo.com and www.bing.com.
     It will send an HTTP "HEAD" request with a (1- X)% probability.
-    Otherwise, it will send a "GET" HTTP request.
+    Otherwise, it will send a "GET" HTTP request on a new connection, closed after the status line and headers.
 
     Args:
         client: HTTPX client.
         main_logger: Python logger object.
+        (optional) liveness: Liveness of the session, to skip the check while the host is proved alive.
+        (optional) make_client: The method to open another HTTPX client of the same proxy session for "GET" requests, None to send "HEAD" only.
     
     Returns:
         The validity of the host.
         "Valid" | "Not valid"
     """
+
+    if liveness != None and liveness.alive():
+        liveness.skipped += 1
+        return "Valid"
+
+    validity = _val_check(client, main_logger, make_client)
+
+    if liveness != None:
+        if validity == "Valid":
+            liveness.prove()
+        else:
+            liveness.forget()
+
+    return validity
+
+
+def _val_check(client, main_logger, make_client=None):
+    """Check the validity of given host, same as val_check without liveness."""
     random.seed()
 
     try:
-        if random.randint(1, 100) > X:
-            validity = client.head("https://www.yahoo.com/").status_code
-        else:
-            validity = client.get("https://www.yahoo.com/").status_code
+        validity = _check_status(client, "https://www.yahoo.com/", make_client)
 
         if validity >= 400:
             validity = "TRY_AGAIN"
@@ -53,10 +138,7 @@ def val_check(client, main_logger):
 
     if validity == "TRY_AGAIN":
         try:
-            if random.randint(1, 100) > X:
-                validity = client.head("https://www.bing.com/").status_code
-            else:
-                validity = client.get("https://www.bing.com/").status_code
+            validity = _check_status(client, "https://www.bing.com/", make_client)
 
             if validity >= 400:
                 return "Not valid"
@@ -72,47 +154,755 @@ def val_check(client, main_logger):
     return "Valid"
 
 
-def get_IP_ISP(client, port, main_logger):
-    """Get sessions then return IP and ISP.
+# Precompiled DNS queries, keyed by (domain, browser, method)
+# Since the ID is fixed to 0 and the padding is fixed, they never change within an experiment.
+_query_cache = {}
+
+
+def _make_query(domain, browser, method):
+    """Build the DNS query in the DoH wire format of the given browser.
 
     Args:
-        client: HTTPX client.
-        port: The port number to use.
-        main_logger: Python logger object.
+        domain: The domain name to query.
+        browser: The browser to mimic.
+        method: The HTTP method to use.
     
     Returns:
-        (ip, isp), both are string or None.
+        The POST body (bytes) or the GET "dns" parameter (string).
     """
 
-    ip = "init"
-    isp = "init"
+    dns_query = dns.message.make_query(qname=domain, rdtype="A", rdclass="IN", id=0)
+
+    if method == Methods.POST:
+        if browser == Browsers.FIREFOX:
+            csubnet = dns.edns.ECSOption("0.0.0.0", 0, 0)
+            dns_query.use_edns(0, payload=4096, pad=128, options=[csubnet])
+        else:
+            dns_query.use_edns(0, payload=4096, pad=128)
+
+        return dns_query.to_wire()
+
+    else: # elif method == Methods.GET:
+        dns_query.use_edns(0, payload=4096, pad=113)
 
-    ### For storing ISP names, make their names valid as the filename.
-    def _into_filename(isp):
-        valid_chars = f"_() {string.ascii_letters}{string.digits}"
-        filename = ''.join(c for c in isp if c in valid_chars)
-        filename = filename.replace(' ', '_')
-        return filename
+        return base64.b64encode(dns_query.to_wire()).decode('ascii').rstrip("=")
+
+
+def get_query(domain, browser, method):
+    """Get the DNS query in the DoH wire format from the cache, building it on a miss.
+
+    Args:
+        domain: The domain name to query.
+        browser: The browser to mimic.
+        method: The HTTP method to use.
     
+    Returns:
+        The POST body (bytes) or the GET "dns" parameter (string).
+    """
+
+    key = (domain, browser, method)
+
     try:
-        sessions = client.get("http://api.proxyrack.net/sessions", headers={'accept': 'application/json'}).json()
-        for session in sessions:
-            if session['port'] == port:
-                ip = session['proxy']['ip']
-                isp = session['proxy']['isp']
-                isp = _into_filename(isp)
-
-                break
-            
-        # There was no given port in session list
-        if ip == "init":
-            return None, None
+        return _query_cache[key]
+    except KeyError:
+        dns_query = _make_query(domain, browser, method)
+        _query_cache[key] = dns_query
+        return dns_query
+
+
+def precompile_queries(domains, browser, method):
+    """Build the DNS queries of the whole domain list once per experiment.
+    Call it before creating the pool, then the forked workers inherit the cache.
+
+    Args:
+        domains: The list of domain names to query.
+        browser: The browser to mimic.
+        method: The HTTP method to use.
+    """
+
+    for domain in domains:
+        get_query(domain, browser, method)
+
+
+def _get_mode(resolver_ip, shadow_resolver, shadow_resolver_ip, nysni):
+    """Classify the circumvention mode by the given optional arguments.
+
+    Args:
+        resolver_ip: The IP address of a DoH resolver.
+        shadow_resolver: The domain name of a shadow resolver.
+        shadow_resolver_ip: The IP address of a shadow resolver.
+        nysni: The shadow hostname to use.
+    
+    Returns:
+        The mode number, or None for wrong configurations.
+    """
+
+    ### modes:
+    ### 0 - Baseline, 1 - Direct IP, 2 - Shadow IP resolution, 3 - Shadow hostname resolution, 
+    ### 4 - Direct IP + Shadow IP resolution, 5 - Direct IP + Shadow hostname resolution
+    if resolver_ip == None and (shadow_resolver == None and shadow_resolver_ip == None) and nysni == None:
+        return 0
+    elif resolver_ip != None and (shadow_resolver == None and shadow_resolver_ip == None) and nysni == None:
+        return 1
+    elif resolver_ip == None and (shadow_resolver != None and shadow_resolver_ip == None) and nysni == None:
+        return 2
+    elif resolver_ip == None and (shadow_resolver == None and shadow_resolver_ip == None) and nysni != None:
+        return 3
+    elif resolver_ip == None and (shadow_resolver != None and shadow_resolver_ip != None) and nysni == None:
+        return 4
+    elif resolver_ip != None and (shadow_resolver == None and shadow_resolver_ip == None) and nysni != None:
+        return 5
+    else:
+        return None
+
+
+# HTTP headers of each browser, in the order they are sent
+_CHROMIUM_HEADERS = (
+    ('accept', 'application/dns-message'),
+    ('content-type', 'application/dns-message'),
+    ('accept-language', '*'),
+    ('user-agent', 'Chrome'),
+    ('accept-encoding', 'identity'),
+)
+
+_FIREFOX_HEADERS = (
+    ('accept', 'application/dns-message'),
+    ('accept-encoding', ''),
+    ('content-type', 'application/dns-message'),
+    ('cache-control', 'no-store, no-cache'),
+    ('pragma', 'no-cache'),
+    ('te', 'trailers'),
+)
+
+
+# Browser profiles, keyed by (browser, method): (headers for each mode, whether to drop the client's User-Agent)
+_PROFILES = {
+    (Browsers.CHROMIUM, Methods.POST): ((_CHROMIUM_HEADERS,) * 6, False),
+    (Browsers.CHROMIUM, Methods.GET): ((_CHROMIUM_HEADERS,) * 6, False),
+    (Browsers.FIREFOX, Methods.POST): ((_FIREFOX_HEADERS,) * 2 + (_CHROMIUM_HEADERS,) * 4, True),
+    (Browsers.FIREFOX, Methods.GET): ((_CHROMIUM_HEADERS,) * 6, False),
+}
+
+
+# For each mode: (the host in the URL, whether to send the host header, the SNI)
+_MODES = (
+    ("resolver", True, None),
+    ("resolver_ip", True, "resolver"),
+    ("shadow_resolver", True, "resolver"),
+    ("resolver", False, "nysni"),
+    ("shadow_resolver_ip", True, "resolver"),
+    ("resolver_ip", True, "nysni"),
+)
+
+# With a shadow hostname, Cloudflare is reached by these hosts instead
+_CLOUDFLARE_HOSTS = {3: "cloudflare-dns.com", 5: "1.1.1.1"}
+
+
+RequestPlan = namedtuple("RequestPlan", ["browser", "method", "url", "headers", "extensions", "drop_user_agent"])
+
+
+@functools.lru_cache(maxsize=None)
+def compile_plan(browser, method, resolver, resolver_ip=None, shadow_resolver=None, shadow_resolver_ip=None, nysni=None):
+    """Compile everything of a DoH request except the query itself.
+    Plans are cached, so each one is built once per experiment (and per worker).
+
+    Args:
+        browser: The browser to mimic.
+        method: The HTTP method to use.
+        resolver: The domain name of a DoH resolver.
+        (optional) resolver_ip: The IP address of a DoH resolver.
+        (optional) shadow_resolver: The domain name of a shadow resolver.
+        (optional) shadow_resolver_ip: The IP address of a shadow resolver.
+        (optional) nysni: The shadow hostname to use.
+    
+    Returns:
+        RequestPlan, or None for wrong configurations.
+    """
+
+    mode = _get_mode(resolver_ip, shadow_resolver, shadow_resolver_ip, nysni)
+
+    if mode == None:
+        return None
+
+    targets = {
+        "resolver": resolver,
+        "resolver_ip": resolver_ip,
+        "shadow_resolver": shadow_resolver,
+        "shadow_resolver_ip": shadow_resolver_ip,
+        "nysni": nysni,
+    }
+
+    url_host, host_header, sni = _MODES[mode]
+    url_host = targets[url_host]
+
+    if mode in _CLOUDFLARE_HOSTS and 'cloudflare' in resolver:
+        url_host = _CLOUDFLARE_HOSTS[mode]
+
+    mode_headers, drop_user_agent = _PROFILES[(browser, method)]
+    headers = mode_headers[mode]
+
+    if host_header:
+        headers = (('host', resolver),) + headers
+
+    if sni == None:
+        extensions = ()
+    else:
+        extensions = (("sni_hostname", targets[sni]),)
+
+    return RequestPlan(browser, method, f"https://{url_host}/dns-query", headers, extensions, drop_user_agent)
+
+
+# Transport phases to record, by the httpcore trace events that mark them
+_TRACE_PHASES = {
+    "socks.connect_tcp.started": "proxy_connect_start",
+    "socks.setup_socks5_connection.complete": "proxy_connect_end",
+    "connection.connect_tcp.started": "connect_start",
+    "connection.connect_tcp.complete": "connect_end",
+    "socks.start_tls.started": "tls_start",
+    "socks.start_tls.complete": "tls_end",
+    "connection.start_tls.started": "tls_start",
+    "connection.start_tls.complete": "tls_end",
+    "http11.send_request_body.complete": "request_sent",
+    "http2.send_request_body.complete": "request_sent",
+    "http11.receive_response_headers.complete": "first_byte",
+    "http2.receive_response_headers.complete": "first_byte",
+    "http11.receive_response_body.complete": "body_complete",
+    "http2.receive_response_body.complete": "body_complete",
+}
+
+
+def _record_trace(timing, start, event_name, info):
+    """Record the trace event into the timing, if it marks a transport phase or a failure.
+
+    Args:
+        timing: The dictionary of phases to fill.
+        start: perf_counter() when the request started.
+        event_name: The name of httpcore trace event.
+        info: The information of httpcore trace event.
+    """
+
+    phase = _TRACE_PHASES.get(event_name)
+
+    if phase != None:
+        timing[phase] = time.perf_counter() - start
+
+        # Whether the handshake was full or resumed from an earlier connection
+        if phase == "tls_end":
+            ssl_object = info["return_value"].get_extra_info("ssl_object")
+            timing["tls_resumed"] = ssl_object != None and ssl_object.session_reused
+
+    elif event_name.endswith(".failed"):
+        timing["failed"] = event_name
+        timing["failed_at"] = time.perf_counter() - start
+
+
+def _make_trace(timing):
+    """Make the callback for the httpcore "trace" extension.
+
+    Args:
+        timing: The dictionary of phases to fill, in seconds since the request started.
+    
+    Returns:
+        The trace callback.
+    """
+
+    timing["started_at"] = time.time()
+    start = time.perf_counter()
+
+    def trace(event_name, info):
+        _record_trace(timing, start, event_name, info)
+
+    return trace
+
+
+def _make_trace_async(timing):
+    """Make the callback for the httpcore "trace" extension, for async clients.
+
+    Args:
+        timing: The dictionary of phases to fill, in seconds since the request started.
+    
+    Returns:
+        The trace coroutine function.
+    """
+
+    timing["started_at"] = time.time()
+    start = time.perf_counter()
+
+    async def trace(event_name, info):
+        _record_trace(timing, start, event_name, info)
+
+    return trace
+
+
+class QueryOutcome:
+    """Outcome of a DoH query, compact enough to hold by the hundred thousand and to pass between processes.
+
+    Args:
+        status_code: The HTTP status code, None if no response has arrived.
+        error: The class of the exception raised during the query, or None.
+        latency: Time taken by the query, in seconds.
+        bytes_sent: The size of the DNS query in the request, in bytes.
+        body: The response from the DoH resolver.
+    """
+
+    __slots__ = ("status_code", "error", "latency", "bytes_sent", "bytes_received", "body")
+
+    def __init__(self, status_code, error, latency, bytes_sent, body):
+        self.status_code = status_code
+        self.error = error
+        self.latency = latency
+        self.bytes_sent = bytes_sent
+        self.bytes_received = len(body)
+        self.body = memoryview(body)
+
+    def __reduce__(self):
+        # memoryview cannot be pickled, so send the underlying bytes
+        return (QueryOutcome, (self.status_code, self.error, self.latency, self.bytes_sent, self.body.obj))
+
+    def __repr__(self):
+        error = None if self.error == None else self.error.__name__
+        return f"QueryOutcome(status_code={self.status_code}, error={error}, latency={self.latency:.3f}, bytes_sent={self.bytes_sent}, bytes_received={self.bytes_received})"
+
+    @property
+    def content(self):
+        """The response as bytes, same as the query functions return."""
+        return self.body.obj
+
+    def classify(self):
+        """Classify the outcome, see classify()."""
+        return classify(self.content, self.status_code, self.error)
+
+
+def _query_size(request):
+    """Get the size of the DNS query in the keyword arguments for client.request()."""
+
+    if "content" in request:
+        return len(request["content"])
+    else:
+        return len(request["params"]["dns"])
+
+
+def classify(response, status_code=None, error=None):
+    """Decode the DoH response once, and classify the outcome of the query.
+
+    Args:
+        response: The response from the DoH resolver.
+        (optional) status_code: The HTTP status code, None if no response has arrived.
+        (optional) error: The class of the exception raised during the query.
     
+    Returns:
+        The compact record of the outcome, in a dictionary.
+    """
+
+    record = {"outcome": None, "status": status_code}
+
+    if error != None:
+        record["error"] = error.__name__
+
+        if issubclass(error, httpx.TimeoutException):
+            record["outcome"] = Outcomes.TIMEOUT.name
+        elif issubclass(error, (httpx.ConnectError, httpx.ProxyError)):
+            record["outcome"] = Outcomes.CONNECT_ERROR.name
+        elif issubclass(error, (httpx.NetworkError, httpx.RemoteProtocolError)):
+            record["outcome"] = Outcomes.RESET.name
+        else:
+            record["outcome"] = Outcomes.ERROR.name
+        
+        return record
+
+    if status_code != None and status_code >= 400:
+        record["outcome"] = Outcomes.HTTP_ERROR.name
+        return record
+
+    if len(response) == 0:
+        record["outcome"] = Outcomes.EMPTY.name
+        return record
+
+    try:
+        message = dns.message.from_wire(response)
     except Exception:
-        main_logger.exception("During getting sessions")
-        return None, None
+        record["outcome"] = Outcomes.MALFORMED.name
+        return record
+
+    rcode = message.rcode()
+    record["rcode"] = dns.rcode.to_text(rcode)
+    record["answers"] = [rdata.to_text() for rrset in message.answer for rdata in rrset]
+
+    if rcode == dns.rcode.NOERROR:
+        record["outcome"] = Outcomes.ANSWER.name if len(record["answers"]) > 0 else Outcomes.NODATA.name
+    elif rcode == dns.rcode.NXDOMAIN:
+        record["outcome"] = Outcomes.NXDOMAIN.name
+    elif rcode == dns.rcode.SERVFAIL:
+        record["outcome"] = Outcomes.SERVFAIL.name
+    else:
+        record["outcome"] = Outcomes.RCODE.name
+
+    return record
+
+
+def _plan_request(plan, domain):
+    """Fill the DNS query of the given domain into the plan.
+
+    Args:
+        plan: RequestPlan from compile_plan.
+        domain: The domain name to query.
+    
+    Returns:
+        Keyword arguments for client.request().
+    """
+
+    dns_query = get_query(domain, plan.browser, plan.method)
+
+    if plan.method == Methods.POST:
+        return dict(method="POST", url=plan.url, content=dns_query, headers=plan.headers, extensions=dict(plan.extensions))
+    else: # elif plan.method == Methods.GET:
+        return dict(method="GET", url=plan.url, params={"dns": dns_query}, headers=plan.headers, extensions=dict(plan.extensions))
+
+
+def send_plan_outcome(client, plan, domain, main_logger, timing=None):
+    """Send DoH query by the compiled plan, keeping the details of the outcome.
+
+    Args:
+        client: HTTPX client.
+        plan: RequestPlan from compile_plan.
+        domain: The domain name to query.
+        main_logger: Python logger object.
+        (optional) timing: The dictionary to fill with the transport timing of the query.
+
+    Returns:
+        QueryOutcome of the query.
+    """
+
+    status_code = None
+    error = None
+    bytes_sent = 0
+    start = time.perf_counter()
+
+    try:
+        request = _plan_request(plan, domain)
+        bytes_sent = _query_size(request)
+
+        if timing != None:
+            request["extensions"]["trace"] = _make_trace(timing)
+
+        if plan.drop_user_agent and "User-Agent" in client.headers:
+            del client.headers["User-Agent"]
+
+        response = client.request(**request)
+        status_code = response.status_code
+        response = response.read()
+
+    except:
+        main_logger.exception("During DoH querying")
+        response = b""
+        error = sys.exc_info()[0]
+
+    return QueryOutcome(status_code, error, time.perf_counter() - start, bytes_sent, response)
+
+
+async def send_plan_outcome_async(client, plan, domain, main_logger, timing=None):
+    """Send DoH query by the compiled plan asynchronously, keeping the details of the outcome.
+
+    Args:
+        client: HTTPX async client.
+        plan: RequestPlan from compile_plan.
+        domain: The domain name to query.
+        main_logger: Python logger object.
+        (optional) timing: The dictionary to fill with the transport timing of the query.
+
+    Returns:
+        QueryOutcome of the query.
+    """
+
+    status_code = None
+    error = None
+    bytes_sent = 0
+    start = time.perf_counter()
+
+    try:
+        request = _plan_request(plan, domain)
+        bytes_sent = _query_size(request)
+
+        if timing != None:
+            request["extensions"]["trace"] = _make_trace_async(timing)
+
+        if plan.drop_user_agent and "User-Agent" in client.headers:
+            del client.headers["User-Agent"]
+
+        response = await client.request(**request)
+        status_code = response.status_code
+        response = await response.aread()
+
+    except:
+        main_logger.exception("During DoH querying")
+        response = b""
+        error = sys.exc_info()[0]
+
+    return QueryOutcome(status_code, error, time.perf_counter() - start, bytes_sent, response)
+
+
+def send_plan(client, plan, domain, main_logger, timing=None, record=None):
+    """Send DoH query by the compiled plan.
+
+    Args:
+        client: HTTPX client.
+        plan: RequestPlan from compile_plan.
+        domain: The domain name to query.
+        main_logger: Python logger object.
+        (optional) timing: The dictionary to fill with the transport timing of the query.
+        (optional) record: The dictionary to fill with the classified outcome of the query.
+
+    Returns:
+        The response from the DoH resolver.
+    """
+
+    outcome = send_plan_outcome(client, plan, domain, main_logger, timing)
+
+    if record != None:
+        record.update(outcome.classify())
+
+    return outcome.content
+
+
+async def send_plan_async(client, plan, domain, main_logger, timing=None, record=None):
+    """Send DoH query by the compiled plan asynchronously.
+
+    Args:
+        client: HTTPX async client.
+        plan: RequestPlan from compile_plan.
+        domain: The domain name to query.
+        main_logger: Python logger object.
+        (optional) timing: The dictionary to fill with the transport timing of the query.
+        (optional) record: The dictionary to fill with the classified outcome of the query.
+
+    Returns:
+        The response from the DoH resolver.
+    """
+
+    outcome = await send_plan_outcome_async(client, plan, domain, main_logger, timing)
+
+    if record != None:
+        record.update(outcome.classify())
+
+    return outcome.content
+
+
+def send_plan_batch(client, plan, domains, main_logger, max_streams, timings=None, records=None, as_outcomes=False):
+    """Send DoH queries for all domains at once, as concurrent streams on the HTTP/2 connection of the client.
+
+    Args:
+        client: HTTPX client.
+        plan: RequestPlan from compile_plan.
+        domains: The list of domain names to query.
+        main_logger: Python logger object.
+        max_streams: The maximum number of concurrent streams.
+        (optional) timings: The list to extend with the transport timing of each query.
+        (optional) records: The list to extend with the classified outcome of each query.
+        (optional) as_outcomes: Return QueryOutcome instead of the responses.
+
+    Returns:
+        The list of responses from the DoH resolver, in the order of domains.
+    """
+
+    # Modify the client headers before the streams share it
+    if plan.drop_user_agent and "User-Agent" in client.headers:
+        del client.headers["User-Agent"]
+
+    if timings == None:
+        batch_timings = [None] * len(domains)
+    else:
+        batch_timings = [{} for _ in domains]
+        timings.extend(batch_timings)
+
+    with ThreadPoolExecutor(max_workers=max_streams) as executor:
+        outcomes = list(executor.map(lambda domain, timing: send_plan_outcome(client, plan, domain, main_logger, timing), domains, batch_timings))
+
+    if records != None:
+        records.extend([outcome.classify() for outcome in outcomes])
+
+    if as_outcomes:
+        return outcomes
+
+    return [outcome.content for outcome in outcomes]
+
+
+class SessionAborted(Exception):
+    """The host is gone in the middle of a session, found after consecutive transport failures."""
+
+
+def _transport_failed(outcome):
+    """Check whether the query failed below HTTP, e.g. by timeouts, resets or the proxy."""
+    return outcome.error != None and issubclass(outcome.error, httpx.TransportError)
+
+
+def _check_failures(client, main_logger, failures, max_failures, make_client=None):
+    """Spend the failure budget of the session.
+    A blocked resolver fails the transport as well, so the host is checked before giving up.
+
+    Returns:
+        The number of consecutive failures to carry on with.
+    """
+
+    if max_failures == 0 or failures < max_failures:
+        return failures
 
-    return ip, isp
+    if val_check(client, main_logger, None, make_client) == "Not valid":
+        raise SessionAborted(f"{failures} consecutive transport failures")
+
+    return 0
+
+
+def _update_liveness(liveness, outcome):
+    """Prove the host alive by an answered DoH query, or drop the proof on a transport failure."""
+
+    if liveness == None:
+        return
+
+    if _transport_failed(outcome):
+        liveness.forget()
+    elif outcome.status_code != None and outcome.status_code < 400:
+        liveness.prove()
+
+
+def query_domains(client, plan, domains, main_logger, y, max_streams=0, timings=None, records=None, as_outcomes=False, max_failures=0, liveness=None, make_check_client=None):
+    """Send DoH queries for all domains, with random connectivity checks between them.
+
+    Args:
+        client: HTTPX client.
+        plan: RequestPlan from compile_plan.
+        domains: The list of domain names to query.
+        main_logger: Python logger object.
+        y: The probability of random connectivity checks between queries.
+        (optional) max_streams: The maximum number of concurrent HTTP/2 streams, 0 for sequential queries.
+        (optional) timings: The list to extend with the transport timing of each query.
+        (optional) records: The list to extend with the classified outcome of each query.
+        (optional) as_outcomes: Return QueryOutcome instead of the responses.
+        (optional) max_failures: The number of consecutive transport failures before checking the host, 0 not to check.
+        (optional) liveness: Liveness of the session, to skip random checks while the host is proved alive.
+        (optional) make_check_client: The method to open another HTTPX client of the same proxy session for "GET" checks, None to send "HEAD" only.
+
+    Returns:
+        The list of responses from the DoH resolver, or None if the host became not valid.
+
+    Raises:
+        SessionAborted: The host failed the check after max_failures consecutive transport failures.
+    """
+
+    if max_streams > 0:
+        # The batch takes a single round trip, so one check covers the draws of every query
+        if any([random.randint(1, 100) <= y for _ in domains]):
+            if val_check(client, main_logger, liveness, make_check_client) == "Not valid":
+                return None
+
+        outcomes = send_plan_batch(client, plan, domains, main_logger, max_streams, timings, records, True)
+
+        failures = 0
+        for outcome in outcomes:
+            _update_liveness(liveness, outcome)
+            failures = failures + 1 if _transport_failed(outcome) else 0
+            failures = _check_failures(client, main_logger, failures, max_failures, make_check_client)
+
+        if as_outcomes:
+            return outcomes
+
+        return [outcome.content for outcome in outcomes]
+
+    outcomes = []
+    failures = 0
+    for domain in domains:
+        if random.randint(1, 100) <= y:
+            if val_check(client, main_logger, liveness, make_check_client) == "Not valid":
+                return None
+
+        if timings == None:
+            timing = None
+        else:
+            timing = {}
+            timings.append(timing)
+
+        outcome = send_plan_outcome(client, plan, domain, main_logger, timing)
+
+        if records != None:
+            records.append(outcome.classify())
+
+        outcomes.append(outcome)
+        _update_liveness(liveness, outcome)
+
+        failures = failures + 1 if _transport_failed(outcome) else 0
+        failures = _check_failures(client, main_logger, failures, max_failures, make_check_client)
+
+    if as_outcomes:
+        return outcomes
+
+    return [outcome.content for outcome in outcomes]
+
+
+def query_modes(client, modes, domains, main_logger, y, max_streams=0, trace=False, decode=False, max_failures=0, make_client=None, liveness=None, make_check_client=None):
+    """Send DoH queries for all domains in every mode of a session.
+
+    Args:
+        client: HTTPX client.
+        modes: The list of (name, plan), where plan is RequestPlan from compile_plan.
+        domains: The list of domain names to query.
+        main_logger: Python logger object.
+        y: The probability of random connectivity checks between queries.
+        (optional) max_streams: The maximum number of concurrent HTTP/2 streams per mode, 0 for sequential queries.
+        (optional) trace: Record the transport timing of each query.
+        (optional) decode: Record the classified outcome of each query.
+        (optional) max_failures: The number of consecutive transport failures before checking the host, 0 not to check.
+        (optional) make_client: The method to open another HTTPX client of the same proxy session.
+            If given, the modes run at once in a random order, each on its own client; otherwise one after another on client.
+        (optional) liveness: Liveness of the session, to skip random checks while the host is proved alive.
+        (optional) make_check_client: The method to open another HTTPX client of the same proxy session for "GET" checks, None to send "HEAD" only.
+
+    Returns:
+        The list of (name, responses, records, timings) in the order of modes, or None if the host became not valid.
+
+    Raises:
+        SessionAborted: The host failed the check after max_failures consecutive transport failures.
+    """
+
+    def query_mode(mode_client, plan):
+        timings = [] if trace else None
+        records = [] if decode else None
+        responses = query_domains(mode_client, plan, domains, main_logger, y, max_streams, timings, records, False, max_failures, liveness, make_check_client)
+        return responses, records, timings
+
+    if make_client == None:
+        results = []
+        for name, plan in modes:
+            responses, records, timings = query_mode(client, plan)
+
+            if responses == None:
+                return None
+
+            results.append((name, responses, records, timings))
+
+        return results
+
+    def query_mode_client(plan):
+        # Separate connections, so that the modes neither share headers nor wait for each other
+        with make_client() as mode_client:
+            return query_mode(mode_client, plan)
+
+    # Start the modes in a random order, so that none of them always goes first through the proxy
+    order = list(range(len(modes)))
+    random.shuffle(order)
+
+    with ThreadPoolExecutor(max_workers=len(modes)) as executor:
+        futures = {i: executor.submit(query_mode_client, modes[i][1]) for i in order}
+
+    # Every mode has finished, so an abort of one does not leave the others running
+    results = []
+    for i, (name, _) in enumerate(modes):
+        responses, records, timings = futures[i].result()
+
+        if responses == None:
+            return None
+
+        results.append((name, responses, records, timings))
+
+    return results
 
 
 def firefox_query(
@@ -125,6 +915,9 @@ def firefox_query(
         shadow_resolver= None,
         shadow_resolver_ip = None,
         nysni= None,
+        timing= None,
+        record= None,
+        as_outcome= False,
 ):
     """Send Firefox-like DoH query.
 
@@ -138,288 +931,80 @@ def firefox_query(
         (optional) shadow_resolver: The domain name of a shadow resolver.
         (optional) shadow_resolver_ip: The IP address of a shadow resolver.
         (optional) nysni: The shadow hostname to use.
+        (optional) timing: The dictionary to fill with the transport timing of the query.
+        (optional) record: The dictionary to fill with the classified outcome of the query.
+        (optional) as_outcome: Return QueryOutcome instead of the response.
     
     Returns:
-        The response from the DoH resolver.
+        The response from the DoH resolver, or QueryOutcome.
     """
 
-    ### modes:
-    ### 0 - Baseline, 1 - Direct IP, 2 - Shadow IP resolution, 3 - Shadow hostname resolution, 
-    ### 4 - Direct IP + Shadow IP resolution, 5 - Direct IP + Shadow hostname resolution
+    plan = compile_plan(Browsers.FIREFOX, method, resolver, resolver_ip, shadow_resolver, shadow_resolver_ip, nysni)
 
-    if resolver_ip == None and (shadow_resolver == None and shadow_resolver_ip == None) and nysni == None:
-        mode = 0
-    elif resolver_ip != None and (shadow_resolver == None and shadow_resolver_ip == None) and nysni == None:
-        mode = 1
-    elif resolver_ip == None and (shadow_resolver != None and shadow_resolver_ip == None) and nysni == None:
-        mode = 2
-    elif resolver_ip == None and (shadow_resolver == None and shadow_resolver_ip == None) and nysni != None:
-        mode = 3
-    elif resolver_ip == None and (shadow_resolver != None and shadow_resolver_ip != None) and nysni == None:
-        mode = 4
-    elif resolver_ip != None and (shadow_resolver == None and shadow_resolver_ip == None) and nysni != None:
-        mode = 5
-    else:
+    if plan == None:
         print("Wrong configurations in firefox_query")
         exit()
 
-    try:
-        if method == Methods.POST:
-            dns_query = dns.message.make_query(qname=domain, rdtype="A", rdclass="IN", id=0)
-            csubnet = dns.edns.ECSOption("0.0.0.0", 0, 0)
-            dns_query.use_edns(0, payload=4096, pad=128, options=[csubnet])
+    if as_outcome:
+        outcome = send_plan_outcome(client, plan, domain, main_logger, timing)
 
-            if "User-Agent" in client.headers:
-                del client.headers["User-Agent"]
-
-            if mode == 0:
-                response = client.post(
-                    url=f"https://{resolver}/dns-query",
-                    content=dns_query.to_wire(),
-                    headers={
-                        'host': resolver,
-                        'accept': 'application/dns-message',
-                        'accept-encoding': '',
-                        'content-type': 'application/dns-message',
-                        'cache-control': 'no-store, no-cache',
-                        'pragma': 'no-cache',
-                        'te': 'trailers'
-                    }
-                ).read()
-            
-            elif mode == 1:
-                response = client.post(
-                    url=f"https://{resolver_ip}/dns-query",
-                    content=dns_query.to_wire(),
-                    headers={
-                        'host': resolver,
-                        'accept': 'application/dns-message',
-                        'accept-encoding': '',
-                        'content-type': 'application/dns-message',
-                        'cache-control': 'no-store, no-cache',
-                        'pragma': 'no-cache',
-                        'te': 'trailers'
-                    },
-                    extensions={"sni_hostname": resolver}
-                ).read()
-            
-            elif mode == 2:
-                response = client.post(
-                    url=f"https://{shadow_resolver}/dns-query",
-                    content=dns_query.to_wire(),
-                    headers={
-                        'host': resolver,
-                        'accept': 'application/dns-message',
-                        'content-type': 'application/dns-message',
-                        'accept-language': '*',
-                        'user-agent': 'Chrome',
-                        'accept-encoding': 'identity'
-                    },
-                    extensions={"sni_hostname": resolver}
-                ).read()
-            
-            elif mode == 3:
-                if 'cloudflare' in resolver:
-                    response = client.post(
-                        url=f"https://cloudflare-dns.com/dns-query",
-                        content=dns_query.to_wire(),
-                        headers={
-                            'accept': 'application/dns-message',
-                            'content-type': 'application/dns-message',
-                            'accept-language': '*',
-                            'user-agent': 'Chrome',
-                            'accept-encoding': 'identity'
-                        },
-                        extensions={"sni_hostname": nysni}
-                    ).read()
-                
-                else:
-                    response = client.post(
-                        url=f"https://{resolver}/dns-query",
-                        content=dns_query.to_wire(),
-                        headers={
-                            'accept': 'application/dns-message',
-                            'content-type': 'application/dns-message',
-                            'accept-language': '*',
-                            'user-agent': 'Chrome',
-                            'accept-encoding': 'identity'
-                        },
-                        extensions={"sni_hostname": nysni}
-                ).read()
-
-            elif mode == 4:
-                response = client.post(
-                    url=f"https://{shadow_resolver_ip}/dns-query",
-                    content=dns_query.to_wire(),
-                    headers={
-                        'host': resolver,
-                        'accept': 'application/dns-message',
-                        'content-type': 'application/dns-message',
-                        'accept-language': '*',
-                        'user-agent': 'Chrome',
-                        'accept-encoding': 'identity'
-                    },
-                    extensions={"sni_hostname": resolver}
-                ).read()
-            
-            else: # elif mode == 5:
-                if 'cloudflare' in resolver:
-                    response = client.post(
-                        url=f"https://1.1.1.1/dns-query",
-                        content=dns_query.to_wire(),
-                        headers={
-                            'host': resolver,
-                            'accept': 'application/dns-message',
-                            'content-type': 'application/dns-message',
-                            'accept-language': '*',
-                            'user-agent': 'Chrome',
-                            'accept-encoding': 'identity'
-                        },
-                        extensions={"sni_hostname": nysni}
-                    ).read()
-                else:
-                    response = client.post(
-                        url=f"https://{resolver_ip}/dns-query",
-                        content=dns_query.to_wire(),
-                        headers={
-                            'host': resolver,
-                            'accept': 'application/dns-message',
-                            'content-type': 'application/dns-message',
-                            'accept-language': '*',
-                            'user-agent': 'Chrome',
-                            'accept-encoding': 'identity'
-                        },
-                        extensions={"sni_hostname": nysni}
-                    ).read()
-        
-        else: # elif method == Methods.GET:
-            dns_query = dns.message.make_query(qname=domain, rdtype="A", rdclass="IN", id=0)
-            dns_query.use_edns(0, payload=4096, pad=113)
-
-            if mode == 0:
-                response = client.get(
-                    url=f"https://{resolver}/dns-query",
-                    params={"dns": base64.b64encode(dns_query.to_wire()).decode('ascii').rstrip("=")},
-                    headers={
-                        'host': resolver,
-                        'accept': 'application/dns-message',
-                        'content-type': 'application/dns-message',
-                        'accept-language': '*',
-                        'user-agent': 'Chrome',
-                        'accept-encoding': 'identity'
-                    }
-                ).read()
-            
-            elif mode == 1:
-                response = client.get(
-                    url=f"https://{resolver_ip}/dns-query",
-                    params={"dns": base64.b64encode(dns_query.to_wire()).decode('ascii').rstrip("=")},
-                    headers={
-                        'host': resolver,
-                        'accept': 'application/dns-message',
-                        'content-type': 'application/dns-message',
-                        'accept-language': '*',
-                        'user-agent': 'Chrome',
-                        'accept-encoding': 'identity'
-                    },
-                    extensions={"sni_hostname": resolver}
-                ).read()
-            
-            elif mode == 2:
-                response = client.get(
-                    url=f"https://{shadow_resolver}/dns-query",
-                    params={"dns": base64.b64encode(dns_query.to_wire()).decode('ascii').rstrip("=")},
-                    headers={
-                        'host': resolver,
-                        'accept': 'application/dns-message',
-                        'content-type': 'application/dns-message',
-                        'accept-language': '*',
-                        'user-agent': 'Chrome',
-                        'accept-encoding': 'identity'
-                    },
-                    extensions={"sni_hostname": resolver}
-                ).read()
-
-            elif mode == 3:
-                if 'cloudflare' in resolver:
-                    response = client.get(
-                        url=f"https://cloudflare-dns.com/dns-query",
-                        params={"dns": base64.b64encode(dns_query.to_wire()).decode('ascii').rstrip("=")},
-                        headers={
-                            'accept': 'application/dns-message',
-                            'content-type': 'application/dns-message',
-                            'accept-language': '*',
-                            'user-agent': 'Chrome',
-                            'accept-encoding': 'identity'
-                        },
-                        extensions={"sni_hostname": nysni}
-                    ).read()
-
-                else:
-                    response = client.get(
-                        url=f"https://{resolver}/dns-query",
-                        params={"dns": base64.b64encode(dns_query.to_wire()).decode('ascii').rstrip("=")},
-                        headers={
-                            'accept': 'application/dns-message',
-                            'content-type': 'application/dns-message',
-                            'accept-language': '*',
-                            'user-agent': 'Chrome',
-                            'accept-encoding': 'identity'
-                        },
-                        extensions={"sni_hostname": nysni}
-                    ).read()
-            
-            elif mode == 4:
-                response = client.get(
-                    url=f"https://{shadow_resolver_ip}/dns-query",
-                    params={"dns": base64.b64encode(dns_query.to_wire()).decode('ascii').rstrip("=")},
-                    headers={
-                        'host': resolver,
-                        'accept': 'application/dns-message',
-                        'content-type': 'application/dns-message',
-                        'accept-language': '*',
-                        'user-agent': 'Chrome',
-                        'accept-encoding': 'identity'
-                    },
-                    extensions={"sni_hostname": resolver}
-                ).read()
-
-            else: # elif mode == 5:
-                if 'cloudflare' in resolver:
-                    response = client.get(
-                        url=f"https://1.1.1.1/dns-query",
-                        params={"dns": base64.b64encode(dns_query.to_wire()).decode('ascii').rstrip("=")},
-                        headers={
-                            'host': resolver,
-                            'accept': 'application/dns-message',
-                            'content-type': 'application/dns-message',
-                            'accept-language': '*',
-                            'user-agent': 'Chrome',
-                            'accept-encoding': 'identity'
-                        },
-                        extensions={"sni_hostname": nysni}
-                    ).read()
-                
-                else:
-                    response = client.get(
-                        url=f"https://{resolver_ip}/dns-query",
-                        params={"dns": base64.b64encode(dns_query.to_wire()).decode('ascii').rstrip("=")},
-                        headers={
-                            'host': resolver,
-                            'accept': 'application/dns-message',
-                            'content-type': 'application/dns-message',
-                            'accept-language': '*',
-                            'user-agent': 'Chrome',
-                            'accept-encoding': 'identity'
-                        },
-                        extensions={"sni_hostname": nysni}
-                    ).read()
- 
-    except:
-        main_logger.exception("During DoH querying")
-        response = b""
+        if record != None:
+            record.update(outcome.classify())
+
+        return outcome
+
+    return send_plan(client, plan, domain, main_logger, timing, record)
+
+
+async def firefox_query_async(
+        client, 
+        resolver, 
+        domain, 
+        main_logger, 
+        method,
+        resolver_ip= None,
+        shadow_resolver= None,
+        shadow_resolver_ip = None,
+        nysni= None,
+        timing= None,
+        record= None,
+        as_outcome= False,
+):
+    """Send Firefox-like DoH query asynchronously.
+
+    Args:
+        client: HTTPX async client.
+        resolver: The domain name of a DoH resolver.
+        domain: The domain name to query.
+        main_logger: Python logger object.
+        method: The HTTP method to use.
+        (optional) resolver_ip: The IP address of a DoH resolver.
+        (optional) shadow_resolver: The domain name of a shadow resolver.
+        (optional) shadow_resolver_ip: The IP address of a shadow resolver.
+        (optional) nysni: The shadow hostname to use.
+        (optional) timing: The dictionary to fill with the transport timing of the query.
+        (optional) record: The dictionary to fill with the classified outcome of the query.
+        (optional) as_outcome: Return QueryOutcome instead of the response.
+    
+    Returns:
+        The response from the DoH resolver, or QueryOutcome.
+    """
+
+    plan = compile_plan(Browsers.FIREFOX, method, resolver, resolver_ip, shadow_resolver, shadow_resolver_ip, nysni)
+
+    if plan == None:
+        print("Wrong configurations in firefox_query_async")
+        exit()
+
+    if as_outcome:
+        outcome = await send_plan_outcome_async(client, plan, domain, main_logger, timing)
+
+        if record != None:
+            record.update(outcome.classify())
+
+        return outcome
 
-    return response
+    return await send_plan_async(client, plan, domain, main_logger, timing, record)
 
 
 def chromium_query(
@@ -432,6 +1017,9 @@ def chromium_query(
         shadow_resolver= None,
         shadow_resolver_ip = None,
         nysni= None,
+        timing= None,
+        record= None,
+        as_outcome= False,
 ):
     """Send Chromium-like DoH query.
 
@@ -445,277 +1033,77 @@ def chromium_query(
         (optional) shadow_resolver: The domain name of a shadow resolver.
         (optional) shadow_resolver_ip: The IP address of a shadow resolver.
         (optional) nysni: The shadow hostname to use.
+        (optional) timing: The dictionary to fill with the transport timing of the query.
+        (optional) record: The dictionary to fill with the classified outcome of the query.
+        (optional) as_outcome: Return QueryOutcome instead of the response.
     
     Returns:
-        The response from the DoH resolver.
+        The response from the DoH resolver, or QueryOutcome.
     """
 
-    ### modes:
-    ### 0 - Baseline, 1 - Direct IP, 2 - Shadow IP resolution, 3 - Shadow hostname resolution, 
-    ### 4 - Direct IP + Shadow IP resolution, 5 - Direct IP + Shadow hostname resolution
-    if resolver_ip == None and (shadow_resolver == None and shadow_resolver_ip == None) and nysni == None:
-        mode = 0
-    elif resolver_ip != None and (shadow_resolver == None and shadow_resolver_ip == None) and nysni == None:
-        mode = 1
-    elif resolver_ip == None and (shadow_resolver != None and shadow_resolver_ip == None) and nysni == None:
-        mode = 2
-    elif resolver_ip == None and (shadow_resolver == None and shadow_resolver_ip == None) and nysni != None:
-        mode = 3
-    elif resolver_ip == None and (shadow_resolver != None and shadow_resolver_ip != None) and nysni == None:
-        mode = 4
-    elif resolver_ip != None and (shadow_resolver == None and shadow_resolver_ip == None) and nysni != None:
-        mode = 5
-    else:
+    plan = compile_plan(Browsers.CHROMIUM, method, resolver, resolver_ip, shadow_resolver, shadow_resolver_ip, nysni)
+
+    if plan == None:
         print("Wrong configurations in chromium_query")
         exit()
 
-    try:
-        if method == Methods.POST:
-            dns_query = dns.message.make_query(qname=domain, rdtype="A", rdclass="IN", id=0)
-            dns_query.use_edns(0, payload=4096, pad=128)
+    if as_outcome:
+        outcome = send_plan_outcome(client, plan, domain, main_logger, timing)
 
-            if mode == 0:
-                response = client.post(
-                    url=f"https://{resolver}/dns-query",
-                    content=dns_query.to_wire(),
-                    headers={
-                        'host': resolver,
-                        'accept': 'application/dns-message',
-                        'content-type': 'application/dns-message',
-                        'accept-language': '*',
-                        'user-agent': 'Chrome',
-                        'accept-encoding': 'identity'
-                    }
-                ).read()
-            
-            elif mode == 1:
-                response = client.post(
-                    url=f"https://{resolver_ip}/dns-query",
-                    content=dns_query.to_wire(),
-                    headers={
-                        'host': resolver,
-                        'accept': 'application/dns-message',
-                        'content-type': 'application/dns-message',
-                        'accept-language': '*',
-                        'user-agent': 'Chrome',
-                        'accept-encoding': 'identity'
-                    },
-                    extensions={"sni_hostname": resolver}
-                ).read()
-            
-            elif mode == 2:
-                response = client.post(
-                    url=f"https://{shadow_resolver}/dns-query",
-                    content=dns_query.to_wire(),
-                    headers={
-                        'host': resolver,
-                        'accept': 'application/dns-message',
-                        'content-type': 'application/dns-message',
-                        'accept-language': '*',
-                        'user-agent': 'Chrome',
-                        'accept-encoding': 'identity'
-                    },
-                    extensions={"sni_hostname": resolver}
-                ).read()
-            
-            elif mode == 3:
-                if 'cloudflare' in resolver:
-                    response = client.post(
-                        url=f"https://cloudflare-dns.com/dns-query",
-                        content=dns_query.to_wire(),
-                        headers={
-                            'accept': 'application/dns-message',
-                            'content-type': 'application/dns-message',
-                            'accept-language': '*',
-                            'user-agent': 'Chrome',
-                            'accept-encoding': 'identity'
-                        },
-                        extensions={"sni_hostname": nysni}
-                    ).read()
-                
-                else:
-                    response = client.post(
-                        url=f"https://{resolver}/dns-query",
-                        content=dns_query.to_wire(),
-                        headers={
-                            'accept': 'application/dns-message',
-                            'content-type': 'application/dns-message',
-                            'accept-language': '*',
-                            'user-agent': 'Chrome',
-                            'accept-encoding': 'identity'
-                        },
-                        extensions={"sni_hostname": nysni}
-                    ).read()
-            
-            elif mode == 4:
-                response = client.post(
-                    url=f"https://{shadow_resolver_ip}/dns-query",
-                    content=dns_query.to_wire(),
-                    headers={
-                        'host': resolver,
-                        'accept': 'application/dns-message',
-                        'content-type': 'application/dns-message',
-                        'accept-language': '*',
-                        'user-agent': 'Chrome',
-                        'accept-encoding': 'identity'
-                    },
-                    extensions={"sni_hostname": resolver}
-                ).read()
-            
-            else: # elif mode == 5:
-                if 'cloudflare' in resolver:
-                    response = client.post(
-                        url=f"https://1.1.1.1/dns-query",
-                        content=dns_query.to_wire(),
-                        headers={
-                            'host': resolver,
-                            'accept': 'application/dns-message',
-                            'content-type': 'application/dns-message',
-                            'accept-language': '*',
-                            'user-agent': 'Chrome',
-                            'accept-encoding': 'identity'
-                        },
-                        extensions={"sni_hostname": nysni}
-                    ).read()
-                else:
-                    response = client.post(
-                        url=f"https://{resolver_ip}/dns-query",
-                        content=dns_query.to_wire(),
-                        headers={
-                            'host': resolver,
-                            'accept': 'application/dns-message',
-                            'content-type': 'application/dns-message',
-                            'accept-language': '*',
-                            'user-agent': 'Chrome',
-                            'accept-encoding': 'identity'
-                        },
-                        extensions={"sni_hostname": nysni}
-                    ).read()
-        
-        else: # elif method == Methods.GET:
-            dns_query = dns.message.make_query(qname=domain, rdtype="A", rdclass="IN", id=0)
-            dns_query.use_edns(0, payload=4096, pad=113)
-
-            if mode == 0:
-                response = client.get(
-                    url=f"https://{resolver}/dns-query",
-                    params={"dns": base64.b64encode(dns_query.to_wire()).decode('ascii').rstrip("=")},
-                    headers={
-                        'host': resolver,
-                        'accept': 'application/dns-message',
-                        'content-type': 'application/dns-message',
-                        'accept-language': '*',
-                        'user-agent': 'Chrome',
-                        'accept-encoding': 'identity'
-                    }
-                ).read()
-            
-            elif mode == 1:
-                response = client.get(
-                    url=f"https://{resolver_ip}/dns-query",
-                    params={"dns": base64.b64encode(dns_query.to_wire()).decode('ascii').rstrip("=")},
-                    headers={
-                        'host': resolver,
-                        'accept': 'application/dns-message',
-                        'content-type': 'application/dns-message',
-                        'accept-language': '*',
-                        'user-agent': 'Chrome',
-                        'accept-encoding': 'identity'
-                    },
-                    extensions={"sni_hostname": resolver}
-                ).read()
-            
-            elif mode == 2:
-                response = client.get(
-                    url=f"https://{shadow_resolver}/dns-query",
-                    params={"dns": base64.b64encode(dns_query.to_wire()).decode('ascii').rstrip("=")},
-                    headers={
-                        'host': resolver,
-                        'accept': 'application/dns-message',
-                        'content-type': 'application/dns-message',
-                        'accept-language': '*',
-                        'user-agent': 'Chrome',
-                        'accept-encoding': 'identity'
-                    },
-                    extensions={"sni_hostname": resolver}
-                ).read()
-
-            elif mode == 3:
-                if 'cloudflare' in resolver:
-                    response = client.get(
-                        url=f"https://cloudflare-dns.com/dns-query",
-                        params={"dns": base64.b64encode(dns_query.to_wire()).decode('ascii').rstrip("=")},
-                        headers={
-                            'accept': 'application/dns-message',
-                            'content-type': 'application/dns-message',
-                            'accept-language': '*',
-                            'user-agent': 'Chrome',
-                            'accept-encoding': 'identity'
-                        },
-                        extensions={"sni_hostname": nysni}
-                    ).read()
-
-                else:
-                    response = client.get(
-                        url=f"https://{resolver}/dns-query",
-                        params={"dns": base64.b64encode(dns_query.to_wire()).decode('ascii').rstrip("=")},
-                        headers={
-                            'accept': 'application/dns-message',
-                            'content-type': 'application/dns-message',
-                            'accept-language': '*',
-                            'user-agent': 'Chrome',
-                            'accept-encoding': 'identity'
-                        },
-                        extensions={"sni_hostname": nysni}
-                    ).read()
-            
-            elif mode == 4:
-                response = client.get(
-                    url=f"https://{shadow_resolver_ip}/dns-query",
-                    params={"dns": base64.b64encode(dns_query.to_wire()).decode('ascii').rstrip("=")},
-                    headers={
-                        'host': resolver,
-                        'accept': 'application/dns-message',
-                        'content-type': 'application/dns-message',
-                        'accept-language': '*',
-                        'user-agent': 'Chrome',
-                        'accept-encoding': 'identity'
-                    },
-                    extensions={"sni_hostname": resolver}
-                ).read()
-
-            else: # elif mode == 5:
-                if 'cloudflare' in resolver:
-                    response = client.get(
-                        url=f"https://1.1.1.1/dns-query",
-                        params={"dns": base64.b64encode(dns_query.to_wire()).decode('ascii').rstrip("=")},
-                        headers={
-                            'host': resolver,
-                            'accept': 'application/dns-message',
-                            'content-type': 'application/dns-message',
-                            'accept-language': '*',
-                            'user-agent': 'Chrome',
-                            'accept-encoding': 'identity'
-                        },
-                        extensions={"sni_hostname": nysni}
-                    ).read()
-                else:
-                    response = client.get(
-                        url=f"https://{resolver_ip}/dns-query",
-                        params={"dns": base64.b64encode(dns_query.to_wire()).decode('ascii').rstrip("=")},
-                        headers={
-                            'host': resolver,
-                            'accept': 'application/dns-message',
-                            'content-type': 'application/dns-message',
-                            'accept-language': '*',
-                            'user-agent': 'Chrome',
-                            'accept-encoding': 'identity'
-                        },
-                        extensions={"sni_hostname": nysni}
-                    ).read()
- 
-    except:
-        main_logger.exception("During DoH querying")
-        response = b""
+        if record != None:
+            record.update(outcome.classify())
+
+        return outcome
+
+    return send_plan(client, plan, domain, main_logger, timing, record)
+
+
+async def chromium_query_async(
+        client, 
+        resolver, 
+        domain, 
+        main_logger, 
+        method,
+        resolver_ip= None,
+        shadow_resolver= None,
+        shadow_resolver_ip = None,
+        nysni= None,
+        timing= None,
+        record= None,
+        as_outcome= False,
+):
+    """Send Chromium-like DoH query asynchronously.
+
+    Args:
+        client: HTTPX async client.
+        resolver: The domain name of a DoH resolver.
+        domain: The domain name to query.
+        main_logger: Python logger object.
+        method: The HTTP method to use.
+        (optional) resolver_ip: The IP address of a DoH resolver.
+        (optional) shadow_resolver: The domain name of a shadow resolver.
+        (optional) shadow_resolver_ip: The IP address of a shadow resolver.
+        (optional) nysni: The shadow hostname to use.
+        (optional) timing: The dictionary to fill with the transport timing of the query.
+        (optional) record: The dictionary to fill with the classified outcome of the query.
+        (optional) as_outcome: Return QueryOutcome instead of the response.
+    
+    Returns:
+        The response from the DoH resolver, or QueryOutcome.
+    """
+
+    plan = compile_plan(Browsers.CHROMIUM, method, resolver, resolver_ip, shadow_resolver, shadow_resolver_ip, nysni)
+
+    if plan == None:
+        print("Wrong configurations in chromium_query_async")
+        exit()
+
+    if as_outcome:
+        outcome = await send_plan_outcome_async(client, plan, domain, main_logger, timing)
+
+        if record != None:
+            record.update(outcome.classify())
+
+        return outcome
 
-    return response
\ No newline at end of file
+    return await send_plan_async(client, plan, domain, main_logger, timing, record)
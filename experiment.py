@@ -0,0 +1,281 @@
+"""experiment.py
+
+This script contains the main loop shared by the experiments, from the experiment directory to the repetitions of every country.
+"""
+
+
+import os
+import logging, time
+import random
+import browsers, proxyrack, storage, scheduler
+
+
+COUNTRIES_RETRY = 60.0 # Time to wait before fetching the country list again, when Proxyrack did not answer, in seconds
+
+
+def _loggers(config):
+    """Set up the loggers of the experiment directory.
+
+    Returns:
+        (main_logger, prog_logger, fail_logger).
+    """
+
+    mode = "a" if config.RESUME else "w"
+
+    # For logging exceptions
+    main_logger = logging.getLogger("main")
+    main_logger.setLevel(logging.ERROR)
+
+    main_logger.addHandler(logging.FileHandler(filename=f"./{config.EXP_NAME}/exceptions.log", encoding="utf-8", mode=mode))
+
+    # For logging progresses
+    prog_logger = logging.getLogger("main.progress")
+    prog_logger.propagate=True
+    prog_logger.setLevel(logging.INFO)
+
+    prog_logger.addHandler(logging.FileHandler(filename=f"./{config.EXP_NAME}/progress.log", encoding="utf-8", mode=mode))
+
+    # For logging failures
+    fail_logger = logging.getLogger("main.failure")
+    fail_logger.propagate=False
+    fail_logger.setLevel(logging.INFO)
+
+    fail_logger.addHandler(logging.FileHandler(filename=f"./{config.EXP_NAME}/fail.log", encoding="utf-8", mode=mode))
+
+    return main_logger, prog_logger, fail_logger
+
+
+def _countries(config, country_counts, prog_logger):
+    """Get the countries to measure, waiting for Proxyrack if the list has to be fetched."""
+
+    if config.COUNTRIES != None:
+        return config.COUNTRIES
+
+    while True:
+        countries = country_counts.countries()
+
+        if countries != None:
+            return countries
+
+        prog_logger.info(f"No country list from Proxyrack, retrying in {COUNTRIES_RETRY} seconds")
+        time.sleep(COUNTRIES_RETRY)
+
+
+def main(config, resolver, domains, queries, verify, func, args, num_queries, contexts=None):
+    """Run the experiment of a script, repeating the sessions of every country REP_COUNT times.
+
+    Args:
+        config: The module of the experiment script, whose constants (API_KEY, EXP_NAME, TIMEOUT, ...) configure the run.
+        resolver: The domain name of a DoH resolver.
+        domains: The list of domain names to query.
+        queries: The list of (browser, method) of the DNS queries to build before forking.
+        verify: Whether the connectivity checks of the sessions verify certificates, for checking ports ahead alike.
+        func: The method for experimentation, called as func(num, country, API_KEY, TIMEOUT, main_logger, *args, directory, store, index).
+        args: The arguments of func particular to the script.
+        num_queries: The number of DoH queries in a recorded session.
+        (optional) contexts: The list of verify settings of the clients of the sessions, [verify] if None.
+    """
+
+    random.seed()
+
+    # Check duplicated experiments
+    if os.path.exists(f"./{config.EXP_NAME}") and not config.RESUME:
+        print(f"{config.EXP_NAME} already exists")
+        exit()
+
+    # Make an experiment directory
+    os.makedirs(config.EXP_NAME, exist_ok=True)
+
+    main_logger, prog_logger, fail_logger = _loggers(config)
+
+    # Count the collected sessions in memory, shared by workers
+    store_manager = storage.StoreManager()
+    store_manager.start()
+    counts = store_manager.CollectionCounts(f"./{config.EXP_NAME}/committed.jsonl")
+
+    # For recording results
+    store = storage.open_store(config.STORAGE, f"./{config.EXP_NAME}", counts)
+
+    # Share the measured IPs among workers, including those of other experiments
+    index = store_manager.IPIndex()
+    index.preload(store)
+    for path in config.SKIP_IPS_FROM:
+        prog_logger.info(f"{index.preload(storage.find_store(path))} IPs of {path} will be skipped")
+
+    # Workers hand their results to a single writer process
+    if config.WRITE_BATCH > 0:
+        store = storage.start_writer(store, config.WRITE_BATCH)
+
+    # Share the Proxyrack session list among workers
+    manager = proxyrack.SessionManager()
+    manager.start()
+    directory = manager.SessionDirectory(config.API_KEY, config.TIMEOUT, main_logger, config.SESSIONS_TTL)
+
+    # Keep the number of available IPs of each country, fetched for every country at once
+    country_counts = proxyrack.CountryCounts(config.API_KEY, config.TIMEOUT, main_logger, config.COUNTS_TTL)
+
+    # To restrict the number of IPs in each country, make sat_list which contains the names of countries have MAX_NUM_IP IPs
+    sat_list = []
+
+    # Build DNS queries once, then forked workers reuse them
+    for browser, method in queries:
+        browsers.precompile_queries(domains, browser, method)
+
+    # Load the CA bundle once, then forked workers reuse the SSLContexts
+    for context in [verify] if contexts == None else contexts:
+        proxyrack.client_factory.ssl_context(context)
+
+    # Open and check the upcoming ports of each country in the background, so that sessions start on live hosts
+    if config.WARM_PORTS > 0:
+        tunnels = proxyrack.TunnelPool(config.API_KEY, config.TIMEOUT, config.CONNECT_TIMEOUT, main_logger, browsers.val_check, config.WARM_PORTS, config.PORT_LIFETIME, verify)
+    else:
+        tunnels = None
+
+    # One pool for every country, forked after the DNS queries are built
+    # A session is given up after TIMEOUT * 3 for its checks, plus a connection and a read per query
+    pool_scheduler = scheduler.Scheduler(
+        config.NUM_PROCESSES, config.TIMEOUT * 3, prog_logger, config.MAX_NUM_IP, config.MIN_SESSIONS, config.MAX_SESSIONS, config.STATUS_INTERVAL,
+        tunnels, config.TIMEOUT + config.CONNECT_TIMEOUT, index, proxyrack.factory_counters, store.counters if config.WRITE_BATCH > 0 else None,
+    )
+
+    # The run state, saved at each step so that RESUME continues from it
+    manifest_path = f"./{config.EXP_NAME}/manifest.json"
+    manifest = storage.read_manifest(manifest_path) if config.RESUME else None
+
+    if manifest == None:
+        manifest = {"repetition": 1, "state": "running", "countries": {}, "sat_list": []}
+
+    sat_list.extend(manifest["sat_list"])
+    manifest["sat_list"] = sat_list
+    storage.write_manifest(manifest_path, manifest)
+
+    exp_count = manifest["repetition"]
+    # Experiment loop
+    while exp_count != config.REP_COUNT + 1:
+        # Sleep before the next experiment, only the rest of it when resumed
+        if manifest["state"] == "sleeping":
+            rest = manifest["sleep_until"] - time.time()
+
+            if rest > 0:
+                print(f"Sleep for {rest / 60} minutes before the next experiment")
+                time.sleep(max(rest - config.COUNTS_LEAD, 0))
+
+                # Refresh the numbers of available IPs, while nothing else runs
+                country_counts.refresh()
+                time.sleep(max(manifest["sleep_until"] - time.time(), 0))
+
+            manifest = {"repetition": exp_count, "state": "running", "countries": {}, "sat_list": sat_list}
+            storage.write_manifest(manifest_path, manifest)
+
+        counts.set_repetition(exp_count)
+
+        prog_logger.info(f"Experiemnt {exp_count} / {config.REP_COUNT} now begins")
+        print(f"Experiemnt {exp_count} / {config.REP_COUNT} now begins")
+
+        # Get available countries
+        countries = _countries(config, country_counts, prog_logger)
+
+        # Exclude countries which already have more than MAX_NUM_IP IPs
+        countries = sorted(list(set(countries) - set(sat_list)))
+
+        if len(countries) == 0:
+            print("No available countries left")
+            exit()
+
+        # Fetch the numbers of available IPs at once, unless refreshed during the sleep
+        country_counts.prefetch(countries)
+
+        # Country loop, queueing the sessions of each country
+        for country in countries:
+            # Sanity check for country names
+            if len(country) != 2:
+                continue
+
+            if country == "CN" and resolver == "dns.google":
+                continue
+
+            if country in manifest["countries"]:
+                # Continue the country where the run stopped, without the sessions committed before
+                if manifest["countries"][country]["finished"]:
+                    continue
+
+                collected_num_ip = manifest["countries"][country]["collected"]
+                num_ip = manifest["countries"][country]["num_ip"] - counts.count_repetition(exp_count, country)
+
+                if num_ip <= 0:
+                    continue
+
+            else:
+                # Get the number of available IPs with the country code
+                num_ip = country_counts.get(country)
+
+                if num_ip == None:
+                    prog_logger.info(f"{country} skipped, no number of available IPs")
+                    continue
+
+                # If there is no avaiable IPs, skip
+                if num_ip == 0:
+                    print(f"No avaiable IP: {country}")
+                    continue
+
+                # Check whether this country hits the limit
+                collected_num_ip = counts.count(country)
+                if collected_num_ip >= config.MAX_NUM_IP:
+                    print(f"{country} hits the limit")
+                    prog_logger.info(f"{country} hits the limit")
+                    sat_list.append(country)
+                    continue
+                # Set num_ip correctly
+                num_ip = min(num_ip, config.MAX_NUM_IP - collected_num_ip)
+
+                manifest["countries"][country] = {"num_ip": num_ip, "collected": collected_num_ip, "finished": False}
+                storage.write_manifest(manifest_path, manifest)
+
+            # Make a country directory
+            store.prepare_country(country)
+
+            prog_logger.info(f"{country} will try to get {num_ip} IPs")
+            print(f"Entering country: {country} with {num_ip} IPs")
+
+            # Queue the sessions of the country
+            pool_scheduler.add_country(country, num_ip, func, (country, config.API_KEY, config.TIMEOUT, main_logger) + tuple(args) + (directory, store, index), num_queries)
+
+        # Run the sessions of every country at once, reporting each country as it ends
+        for country, _, elapsed in pool_scheduler.run():
+            num_ip = manifest["countries"][country]["num_ip"]
+            collected_num_ip = manifest["countries"][country]["collected"]
+
+            # Wait for the writer process
+            store.flush()
+
+            prog_logger.info(f"{country} with {num_ip} IPs took {elapsed} seconds.")
+
+            actual_num = counts.count(country) - collected_num_ip
+            fail_logger.info(f"{country}-{num_ip - actual_num}")
+
+            # Skip this country in the next experiments, without asking Proxyrack
+            if collected_num_ip + actual_num >= config.MAX_NUM_IP:
+                sat_list.append(country)
+
+            manifest["countries"][country]["finished"] = True
+            storage.write_manifest(manifest_path, manifest)
+
+            print(f"End of country: {country}")
+
+        prog_logger.info(f"Experiemnt {exp_count} / {config.REP_COUNT} has ended")
+        print(f"Experiemnt {exp_count} / {config.REP_COUNT} has ended")
+
+        exp_count += 1
+
+        # Record the sleep before the next experiment, or the end of the run
+        manifest = {"repetition": exp_count, "state": "sleeping" if exp_count != config.REP_COUNT + 1 else "done", "sleep_until": time.time() + config.INTERVAL, "countries": {}, "sat_list": sat_list}
+        storage.write_manifest(manifest_path, manifest)
+
+    # Write everything queued before exiting
+    pool_scheduler.close()
+    country_counts.close()
+
+    if tunnels != None:
+        tunnels.close()
+
+    store.close()
\ No newline at end of file
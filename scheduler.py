@@ -0,0 +1,426 @@
+"""scheduler.py
+
+This script contains methods for running the sessions of every country on a single long-lived pool.
+"""
+
+
+import os
+import time
+import queue
+from collections import Counter
+from multiprocessing import Pool
+
+
+class Controller:
+    """Limit of running sessions of a country, raised on successes and cut on failures (AIMD).
+    It doubles the limit every round until the failure rate gets high, as TCP slow start does.
+
+    Args:
+        minimum: The lower bound of the limit.
+        maximum: The upper bound of the limit.
+        (optional) increase: The limit added per round of successful sessions.
+        (optional) decrease: The factor to multiply the limit on failures.
+        (optional) max_failure_rate: The failure rate tolerated without cutting the limit, as some hosts always fail.
+    """
+
+    def __init__(self, minimum, maximum, increase=1.0, decrease=0.5, max_failure_rate=0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.max_failure_rate = max_failure_rate
+
+        self.limit = float(minimum)
+        self.latency = None
+        self.failure_rate = 0.0
+        self.successes = 0
+        self.failures = 0
+        self._slow_start = True
+        self._decreased_at = 0.0
+
+    def update(self, success, latency):
+        """Adjust the limit by a finished session.
+
+        Args:
+            success: Whether the session went through the proxy.
+            latency: Time taken by the session, in seconds.
+
+        Returns:
+            True if the limit has been cut.
+        """
+
+        # Moving averages of session latency and failures
+        self.latency = latency if self.latency == None else 0.8 * self.latency + 0.2 * latency
+        self.failure_rate = 0.9 * self.failure_rate + (0.0 if success else 0.1)
+
+        if success:
+            self.successes += 1
+
+            if self._slow_start:
+                self.limit = min(self.maximum, self.limit + 1)
+            else:
+                self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+
+            return False
+
+        self.failures += 1
+
+        if self.failure_rate <= self.max_failure_rate:
+            return False
+
+        self._slow_start = False
+
+        # Cut once per round, as the failures of running sessions share the same cause
+        now = time.monotonic()
+        if now - self._decreased_at < self.latency:
+            return False
+
+        self._decreased_at = now
+        allowed = self.allowed()
+        self.limit = max(self.minimum, self.limit * self.decrease)
+        return self.allowed() < allowed
+
+    def allowed(self):
+        """The number of sessions allowed to run at once."""
+        return int(self.limit)
+
+
+def _run_job(func, args, kwds, counters):
+    """Run a job in a worker process, along with the counters of the process.
+
+    Returns:
+        (pid, result, counters), where counters is None if no method is given.
+    """
+
+    result = func(*args, **kwds)
+    return os.getpid(), result, None if counters == None else counters()
+
+
+def _outcome(result, error):
+    """Label the result of a job for the status line."""
+
+    if error != None:
+        return "error"
+
+    if result in ("Not valid", "IP not found", "Aborted"):
+        return result
+
+    if result.startswith("Duplicated IP"):
+        return "Duplicated IP"
+
+    return "recorded"
+
+
+class Scheduler:
+    """Feed (country, port) jobs of every country to one pool, so that countries overlap instead of waiting for the last straggler of each.
+    The jobs of countries are interleaved, and each country is reported once all of its jobs have finished.
+    Each country runs as many jobs as its Controller allows, so failing countries are not flooded with timeouts.
+    Results are gathered as they complete, with a status line printed and logged every status_interval.
+    A job running for longer than the bound of its country is given up, while the pool is replaced only once every process holds a given up job.
+    Counters of the worker processes, e.g. proxyrack.factory_counters, are summed on the status line, as they are never seen by the parent otherwise.
+
+    Args:
+        processes: The number of worker processes.
+        timeout: Time a job may run before it is given up, in seconds.
+        prog_logger: Python logger object for progresses.
+        num_ports: The number of ports to rotate, starting from 10001.
+        (optional) min_sessions: The minimum number of running jobs per country.
+        (optional) max_sessions: The maximum number of running jobs per country, processes if None.
+        (optional) status_interval: Time between status lines, in seconds.
+        (optional) tunnels: proxyrack.TunnelPool to open and check the upcoming ports of each country ahead, None not to.
+        (optional) query_timeout: Time added to timeout per DoH query of a job, in seconds.
+        (optional) index: Proxy of storage.IPIndex, to release the IPs claimed by given up or failed jobs.
+        (optional) counters: Module-level method returning a dictionary of the counters of a worker process, None not to report any.
+        (optional) status: Method returning a dictionary of counters of the parent, e.g. storage.QueuedStore.counters, None not to report any.
+    """
+
+    def __init__(self, processes, timeout, prog_logger, num_ports, min_sessions=1, max_sessions=None, status_interval=30.0, tunnels=None, query_timeout=0.0, index=None, counters=None, status=None):
+        self.processes = processes
+        self.timeout = timeout
+        self.prog_logger = prog_logger
+        self.num_ports = num_ports
+        self.min_sessions = min_sessions
+        self.max_sessions = processes if max_sessions == None else max_sessions
+        self.status_interval = status_interval
+        self.tunnels = tunnels
+        self.query_timeout = query_timeout
+        self.index = index
+        self.counters = counters
+        self.status = status
+
+        self._pool = Pool(processes=processes)
+        self._results = queue.Queue()
+        self._given_up = set() # Jobs given up, still holding their processes
+        self._countries = {}
+        self._next_num = 0
+        self._next_job = 0
+
+        # Statistics for the status line
+        self._outcomes = Counter()
+        self._sessions = 0
+        self._queries = 0
+        self._status_at = time.monotonic()
+        self._worker_counters = {} # pid: counters
+
+    def add_country(self, country, num_ip, func, args, queries=0):
+        """Queue the jobs of a country.
+
+        Args:
+            country: Country code (ISO 3166-1 alpha-2).
+            num_ip: The number of jobs to run.
+            func: The method for experimentation, called as func(num, *args), plus checked_at for a port checked ahead.
+            args: The arguments of func following the port number.
+            (optional) queries: The number of DoH queries in a recorded session.
+        """
+
+        self._countries[country] = {
+            "func": func,
+            "args": tuple(args),
+            "num_ip": num_ip,
+            "pending": num_ip,
+            "remaining": num_ip,
+            "started_at": None,
+            "queries": queries,
+            "timeout": self.timeout + queries * self.query_timeout,
+            "controller": Controller(self.min_sessions, self.max_sessions),
+        }
+
+    def _running(self, country):
+        state = self._countries[country]
+        return state["remaining"] - state["pending"]
+
+    def _pending(self):
+        """Get the countries which have jobs to run, under the limit of their controllers."""
+        return [
+            country for country, state in self._countries.items()
+            if state["pending"] > 0 and self._running(country) < state["controller"].allowed()
+        ]
+
+    def _next_port(self):
+        # Ports in flight never collide, as long as fewer jobs and warming ports than num_ports run at once
+        num = self._next_num % self.num_ports + 1
+        self._next_num += 1
+        return num
+
+    def _warm(self):
+        """Keep the upcoming ports of each country opened and checked, up to the jobs it has left."""
+
+        for country, state in self._countries.items():
+            while self.tunnels.count(country) < min(self.tunnels.size, state["pending"]):
+                self.tunnels.warm(country, self._next_port())
+
+    def _submit(self, running):
+        # Take the next job from the country with the fewest running jobs
+        country = min(self._pending(), key=self._running)
+        state = self._countries[country]
+        state["pending"] -= 1
+
+        if state["started_at"] == None:
+            state["started_at"] = time.time()
+
+        # A checked port if any, with the time of its check for the job to skip its own, otherwise the next one in turn
+        tunnel = None if self.tunnels == None else self.tunnels.take(country)
+        if tunnel == None:
+            num, kwds = self._next_port(), {}
+        else:
+            num, checked_at = tunnel
+            kwds = {"checked_at": checked_at}
+
+        job = self._next_job
+        self._next_job += 1
+        started_at = time.monotonic()
+        running[job] = (country, num, started_at, started_at + state["timeout"])
+
+        self._pool.apply_async(
+            _run_job,
+            (state["func"], (num,) + state["args"], kwds, self.counters),
+            callback=lambda result: self._results.put((job, result, None)),
+            error_callback=lambda error: self._results.put((job, None, error)),
+        )
+
+    def _finish(self, country, num, started_at, outcome):
+        """Count a finished job, and report the country if it has no job left.
+
+        Returns:
+            (country, num_ip, elapsed) or None.
+        """
+
+        state = self._countries[country]
+        state["remaining"] -= 1
+
+        # Given up and failed jobs never commit their claims, unless given up jobs finish later anyway
+        if self.index != None:
+            if outcome in ("timeout", "error"):
+                self.index.release_port(country, num)
+            else:
+                self.index.settle(country, num)
+
+        self._outcomes[outcome] += 1
+        self._sessions += 1
+        if outcome == "recorded":
+            self._queries += state["queries"]
+
+        # Duplicated IPs still went through the proxy
+        success = outcome in ("recorded", "Duplicated IP")
+
+        if state["controller"].update(success, time.monotonic() - started_at):
+            self.prog_logger.info(f"{country} now runs up to {state['controller'].allowed()} sessions")
+
+        if state["remaining"] == 0:
+            del self._countries[country]
+
+            if self.tunnels != None:
+                self.tunnels.discard(country)
+
+            return country, state["num_ip"], time.time() - state["started_at"]
+
+        return None
+
+    def _status(self, running):
+        """Print and log the rates since the last status line, the outcomes of this run and the ETA of each country."""
+
+        now = time.monotonic()
+        elapsed = max(now - self._status_at, 1e-9)
+
+        etas = []
+        for country, state in self._countries.items():
+            done = state["num_ip"] - state["remaining"]
+
+            if done > 0:
+                eta = f"{(time.time() - state['started_at']) / done * state['remaining']:.0f}s"
+            else:
+                eta = "-"
+
+            etas.append(f"{country} {done}/{state['num_ip']} ETA {eta}")
+
+        status = (
+            f"Status: {self._sessions / elapsed:.2f} sessions/s, {self._queries / elapsed:.2f} queries/s, {len(running)} in flight, {len(self._given_up)} given up"
+            f" | {', '.join(f'{outcome} {count}' for outcome, count in sorted(self._outcomes.items()))}"
+            f" | {', '.join(etas)}"
+        )
+
+        if len(self._worker_counters) > 0:
+            totals = Counter()
+            for counters in self._worker_counters.values():
+                totals.update(counters)
+
+            status += f" | {', '.join(f'{name} {count}' for name, count in totals.items())}"
+
+        if self.status != None:
+            counters = self.status()
+
+            if len(counters) > 0:
+                status += f" | {', '.join(f'{name} {count}' for name, count in sorted(counters.items()))}"
+
+        if self.tunnels != None:
+            status += f" | tunnels {self.tunnels.ready()} ready, {self.tunnels.taken} taken, {self.tunnels.failed} failed, {self.tunnels.expired} expired"
+
+        print(status)
+        self.prog_logger.info(status)
+
+        self._sessions = 0
+        self._queries = 0
+        self._status_at = now
+
+    def _give_up(self, running):
+        """Give up the jobs running for longer than the bound of their countries, leaving their processes to finish them.
+
+        Returns:
+            Generator of (country, num_ip, elapsed) of the countries left with no job.
+        """
+
+        now = time.monotonic()
+
+        for job, (country, num, started_at, deadline) in list(running.items()):
+            if now < deadline:
+                continue
+
+            del running[job]
+            self._given_up.add(job)
+
+            self.prog_logger.info(f"TimeoutError: {country} session on port {num + 10000} given up after {now - started_at:.0f}s")
+            print("TimeoutError")
+
+            finished = self._finish(country, num, started_at, "timeout")
+            if finished != None:
+                yield finished
+
+    def run(self):
+        """Run every queued job, yielding each country as it finishes.
+
+        Returns:
+            Generator of (country, num_ip, elapsed), where elapsed is the time from its first job to its last, in seconds.
+        """
+
+        running = {}
+
+        self._outcomes.clear()
+        self._sessions = 0
+        self._queries = 0
+        self._status_at = time.monotonic()
+
+        while len(self._countries) > 0:
+            if self.tunnels != None:
+                self._warm()
+
+            # Given up jobs still hold their processes
+            while len(self._pending()) > 0 and len(running) + len(self._given_up) < self.processes:
+                self._submit(running)
+
+            if time.monotonic() - self._status_at >= self.status_interval:
+                self._status(running)
+
+            yield from self._give_up(running)
+
+            if len(self._countries) == 0:
+                break
+
+            # Replace the pool only once every process holds a given up job, e.g. by a deadlock
+            if len(running) == 0 and len(self._given_up) >= self.processes:
+                self.prog_logger.info("TimeoutError: Deadlock, or uncleared child process, whatever.")
+                print("TimeoutError")
+
+                self._pool.terminate()
+                self._pool = Pool(processes=self.processes)
+                self._given_up.clear()
+                continue
+
+            # Wake up for the next status line, or when the first running job is to be given up
+            wait = min([self._status_at + self.status_interval] + [deadline for _, _, _, deadline in running.values()]) - time.monotonic()
+
+            try:
+                job, result, error = self._results.get(timeout=max(wait, 0))
+
+            except queue.Empty:
+                continue
+
+            # Counters are cumulative per process, so the last ones of each process are kept
+            if error == None:
+                pid, result, counters = result
+
+                if counters != None:
+                    self._worker_counters[pid] = counters
+
+            # Given up jobs free their processes, but their results were counted as timeouts
+            if job in self._given_up:
+                self._given_up.discard(job)
+                continue
+
+            # Results from a replaced pool
+            if job not in running:
+                continue
+
+            if error != None:
+                self.prog_logger.error("Hmmmm....", exc_info=error)
+                print("Unknown error")
+            else:
+                print(f"Finished case: {result}")
+
+            country, num, started_at, _ = running.pop(job)
+
+            finished = self._finish(country, num, started_at, _outcome(result, error))
+            if finished != None:
+                yield finished
+
+    def close(self):
+        self._pool.terminate()
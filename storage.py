@@ -0,0 +1,854 @@
+"""storage.py
+
+This script contains methods for recording the results of experiments, either as one file per query or in a single database.
+"""
+
+
+import os, shutil
+import json, time, logging
+import threading
+import sqlite3
+import multiprocessing
+from multiprocessing.managers import BaseManager
+from queue import Empty
+
+
+class SessionBuffer:
+    """Results of a session kept in memory, so that nothing touches the disk until the session is committed.
+
+    Args:
+        country: Country code (ISO 3166-1 alpha-2).
+        ip: The IP address of the connected host.
+    """
+
+    def __init__(self, country, ip):
+        self.country = country
+        self.ip = ip
+        self.isp = None
+        self.handshakes = None
+        self.results = []
+
+    @property
+    def modes(self):
+        """The list of buffered modes, [None] for the baseline."""
+        return [mode for mode, _, _, _ in self.results] if len(self.results) > 0 else [None]
+
+    def write_responses(self, mode, responses, records=None, timings=None):
+        """Buffer the results of a mode.
+
+        Args:
+            mode: The mode to record, None for the baseline.
+            responses: The list of responses from the DoH resolver, or None not to keep them.
+            (optional) records: The list of classified outcomes.
+            (optional) timings: The list of transport timings.
+        """
+        self.results.append((mode, responses, records, timings))
+
+    def write_isp(self, isp):
+        """Buffer the ISP of the IP."""
+        self.isp = isp
+
+    def write_handshakes(self, full, resumed):
+        """Buffer the numbers of full and resumed TLS handshakes of the session."""
+        self.handshakes = {"full": full, "resumed": resumed}
+
+
+class CollectionCounts:
+    """Number of committed sessions per country and per mode, kept in memory.
+    The stores add to it as sessions commit, so the main loop never scans the results for quotas.
+    Every session is also appended to a manifest of (repetition, country, ip, modes), from which the counts are loaded again on resume.
+
+    Args:
+        path: The path of the manifest file, one JSON line per session.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.repetition = None
+        self._counts = {}
+        self._repetitions = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path) as input_file:
+                lines = input_file.read().split("\n")
+
+            # A crash might cut the last line, so start the next one on a new line
+            if lines[-1] != "":
+                with open(path, 'a') as output_file:
+                    output_file.write("\n")
+
+            for line in lines:
+                # Skip the lines cut by crashes
+                try:
+                    unit = json.loads(line)
+                except ValueError:
+                    continue
+
+                self._count(unit["repetition"], unit["country"], unit["modes"])
+
+    def _count(self, repetition, country, modes):
+        counts = self._counts.setdefault(country, {"sessions": 0, "modes": {}})
+        counts["sessions"] += 1
+
+        for mode in modes:
+            if mode != None:
+                counts["modes"][mode] = counts["modes"].get(mode, 0) + 1
+
+        self._repetitions[(repetition, country)] = self._repetitions.get((repetition, country), 0) + 1
+
+    def persisted(self):
+        """Check whether the manifest has been saved before."""
+        return os.path.exists(self.path)
+
+    def set_repetition(self, repetition):
+        """Set the repetition of the sessions committed from now on."""
+        self.repetition = repetition
+
+    def add(self, country, modes, ip=None):
+        """Count a committed session.
+
+        Args:
+            country: Country code (ISO 3166-1 alpha-2).
+            modes: The list of modes of the session, [None] for the baseline.
+            (optional) ip: The IP address of the connected host.
+        """
+
+        with self._lock:
+            self._count(self.repetition, country, modes)
+
+            with open(self.path, 'a') as output_file:
+                output_file.write(json.dumps({"repetition": self.repetition, "country": country, "ip": ip, "modes": modes}) + "\n")
+
+    def count(self, country, mode=None):
+        """Get the number of sessions committed in the country, or those with the mode."""
+
+        with self._lock:
+            counts = self._counts.get(country, {"sessions": 0, "modes": {}})
+            return counts["sessions"] if mode == None else counts["modes"].get(mode, 0)
+
+    def count_repetition(self, repetition, country):
+        """Get the number of sessions committed in the country during the repetition."""
+
+        with self._lock:
+            return self._repetitions.get((repetition, country), 0)
+
+    def rebuild(self, store):
+        """Count every session in the store once, for experiments recorded before the manifest.
+        Their repetitions are unknown, so they are recorded as None.
+        """
+
+        with self._lock:
+            self._counts = {}
+            self._repetitions = {}
+
+            with open(self.path, 'w') as output_file:
+                pass
+
+        for country in store.countries():
+            for ip, _ in list(store.sessions(country)):
+                self.add(country, store.modes(country, ip), ip)
+
+
+class IPIndex:
+    """Set of (country, IP) measured or being measured, so that workers claim each IP once as soon as it is known.
+    Claims of running sessions are also kept by port, so that the scheduler can release those of sessions it gave up.
+    """
+
+    def __init__(self):
+        self._ips = set()
+        self._ports = {} # (country, port): IP claimed by the running session
+        self._lock = threading.Lock()
+
+    def claim(self, country, ip, port=None):
+        """Test and set the IP at once.
+
+        Args:
+            country: Country code (ISO 3166-1 alpha-2).
+            ip: The IP address of the connected host.
+            (optional) port: The port number of the session.
+
+        Returns:
+            False if the IP has been claimed before.
+        """
+
+        with self._lock:
+            if (country, ip) in self._ips:
+                return False
+
+            self._ips.add((country, ip))
+
+            if port != None:
+                self._ports[(country, port)] = ip
+
+            return True
+
+    def release(self, country, ip):
+        """Release the IP of a failed session, so that it can be measured again."""
+
+        with self._lock:
+            self._ips.discard((country, ip))
+
+    def settle(self, country, port):
+        """Forget the port of a finished session, keeping its claim as it is."""
+
+        with self._lock:
+            self._ports.pop((country, port), None)
+
+    def release_port(self, country, port):
+        """Release the IP claimed by the session of the port, e.g. given up by the scheduler."""
+
+        with self._lock:
+            ip = self._ports.pop((country, port), None)
+
+            if ip != None:
+                self._ips.discard((country, ip))
+
+    def preload(self, store):
+        """Claim every IP recorded in the store, e.g. from earlier repetitions or other experiments.
+
+        Returns:
+            The number of IPs newly claimed.
+        """
+
+        num = 0
+        for country in store.countries():
+            for ip, _ in list(store.sessions(country)):
+                if self.claim(country, ip):
+                    num += 1
+
+        return num
+
+
+class StoreManager(BaseManager):
+    """Serve CollectionCounts and IPIndex from the parent, so that pool workers and the writer process share them."""
+
+
+StoreManager.register("CollectionCounts", CollectionCounts)
+StoreManager.register("IPIndex", IPIndex)
+
+
+class DirectoryStore:
+    """Record results in the original layout, {path}/{country}/{ip}/{mode}/{trial} plus an isp_{isp} file.
+    For the baseline, the mode is None and the trials are right in the IP directory.
+    TLS handshake counts of the session, if any, are in a handshakes.json file of the IP directory.
+
+    Args:
+        path: The experiment directory.
+        (optional) counts: CollectionCounts to add the committed sessions to.
+    """
+
+    def __init__(self, path, counts=None):
+        self.path = path
+        self.counts = counts
+
+    def _dir(self, country, ip=None, mode=None):
+        path = f"{self.path}/{country}"
+
+        if ip != None:
+            path += f"/{ip}"
+
+        if mode != None:
+            path += f"/{mode}"
+
+        return path
+
+    def prepare_country(self, country):
+        """Make the directory of the country, if it does not exist."""
+        os.makedirs(self._dir(country), exist_ok=True)
+
+    def has_ip(self, country, ip):
+        """Check whether the IP is recorded in the country."""
+        return os.path.exists(self._dir(country, ip))
+
+    def sweep(self):
+        """Remove the temporary directories left by crashed runs, before any session of this run is committed."""
+        shutil.rmtree(f"{self.path}/.incomplete", ignore_errors=True)
+
+    def commit_session(self, session):
+        """Record the buffered session at once.
+        The files are written in a temporary directory first, then renamed into the country directory,
+        so that a crash never leaves a half-written IP directory behind.
+
+        Args:
+            session: SessionBuffer of the session.
+
+        Returns:
+            False if the IP has been recorded by another session.
+        """
+
+        temp_path = f"{self.path}/.incomplete/{session.country}_{session.ip}_{os.getpid()}"
+
+        # Left by a crashed run whose process had the same PID
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs(temp_path)
+
+        try:
+            for mode, responses, records, timings in session.results:
+                path = temp_path if mode == None else f"{temp_path}/{mode}"
+                if mode != None:
+                    os.mkdir(path)
+
+                self._write_responses(path, responses, records, timings)
+
+            if session.isp != None:
+                with open(f"{temp_path}/isp_{session.isp}", 'w') as output_file:
+                    output_file.write("")
+
+            if session.handshakes != None:
+                with open(f"{temp_path}/handshakes.json", 'w') as output_file:
+                    json.dump(session.handshakes, output_file)
+
+            # Fails if the IP directory exists, as it is never empty
+            os.rename(temp_path, self._dir(session.country, session.ip))
+
+        except Exception as error:
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+            if isinstance(error, OSError) and self.has_ip(session.country, session.ip):
+                return False
+
+            raise
+
+        if self.counts != None:
+            self.counts.add(session.country, session.modes, session.ip)
+
+        return True
+
+    def _write_responses(self, path, responses, records, timings):
+        if responses != None:
+            for trial, response in enumerate(responses):
+                with open(f"{path}/{trial}", 'wb') as output_file:
+                    output_file.write(response)
+
+        if records != None:
+            with open(f"{path}/outcomes.json", 'w') as output_file:
+                json.dump(records, output_file)
+
+        if timings != None:
+            with open(f"{path}/timing.json", 'w') as output_file:
+                json.dump(timings, output_file)
+
+    def apply(self, ops):
+        """Apply the writes of (method name, args) in order, for the writer process.
+        Each write stands alone, so that a failing one never loses the others.
+
+        Returns:
+            The list of the return values, or of the exceptions raised by the failed writes.
+        """
+
+        results = []
+        for name, args in ops:
+            try:
+                results.append(getattr(self, name)(*args))
+
+            except Exception as error:
+                results.append(error)
+
+        return results
+
+    def flush(self):
+        pass
+
+    def countries(self):
+        """Get the list of recorded countries."""
+        return sorted(entry.name for entry in os.scandir(self.path) if entry.is_dir() and not entry.name.startswith("."))
+
+    def sessions(self, country):
+        """Yield (ip, isp) recorded in the country."""
+        for entry in os.scandir(self._dir(country)):
+            isp = None
+            for name in os.listdir(entry.path):
+                if name.startswith("isp_"):
+                    isp = name[len("isp_"):]
+
+            yield entry.name, isp
+
+    def handshakes(self, country, ip):
+        """Get the TLS handshake counts of the IP as {"full": n, "resumed": n}, or None if not recorded."""
+        path = f"{self._dir(country, ip)}/handshakes.json"
+
+        if not os.path.isfile(path):
+            return None
+
+        with open(path) as input_file:
+            return json.load(input_file)
+
+    def modes(self, country, ip):
+        """Get the list of recorded modes of the IP, [None] for the baseline."""
+        modes = sorted(entry.name for entry in os.scandir(self._dir(country, ip)) if entry.is_dir())
+        return modes if len(modes) > 0 else [None]
+
+    def responses(self, country, ip, mode=None):
+        """Yield (trial, response, record, timing) recorded for the mode, in the order of trials.
+        The response is None if it was not kept, and so are the record and the timing if not recorded.
+        """
+
+        path = self._dir(country, ip, mode)
+        names = os.listdir(path)
+        records = timings = []
+
+        if "outcomes.json" in names:
+            with open(f"{path}/outcomes.json") as input_file:
+                records = json.load(input_file)
+
+        if "timing.json" in names:
+            with open(f"{path}/timing.json") as input_file:
+                timings = json.load(input_file)
+
+        trials = sorted(int(name) for name in names if name.isdigit())
+        for trial in range(max(len(records), len(timings), (trials[-1] + 1) if len(trials) > 0 else 0)):
+            response = None
+            if os.path.isfile(f"{path}/{trial}"):
+                with open(f"{path}/{trial}", 'rb') as input_file:
+                    response = input_file.read()
+
+            yield (
+                trial,
+                response,
+                records[trial] if trial < len(records) else None,
+                timings[trial] if trial < len(timings) else None,
+            )
+
+    def close(self):
+        pass
+
+
+class SQLiteStore:
+    """Record results in a single SQLite database in WAL mode, instead of millions of small files.
+    Each process opens its own connection, so the store can be passed to pool workers.
+
+    Args:
+        path: The path of the database file.
+        (optional) counts: CollectionCounts to add the committed sessions to.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            country TEXT NOT NULL,
+            ip TEXT NOT NULL,
+            isp TEXT,
+            modes TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            PRIMARY KEY (country, ip)
+        );
+        CREATE TABLE IF NOT EXISTS responses (
+            country TEXT NOT NULL,
+            ip TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            trial INTEGER NOT NULL,
+            response BLOB,
+            outcome TEXT,
+            timing TEXT,
+            PRIMARY KEY (country, ip, mode, trial)
+        );
+        CREATE TABLE IF NOT EXISTS handshakes (
+            country TEXT NOT NULL,
+            ip TEXT NOT NULL,
+            full INTEGER NOT NULL,
+            resumed INTEGER NOT NULL,
+            PRIMARY KEY (country, ip)
+        );
+    """
+
+    def __init__(self, path, counts=None):
+        self.path = path
+        self.counts = counts
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        return {"path": self.path, "counts": self.counts}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["counts"])
+
+    def _db(self):
+        if self._conn == None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60.0)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self._SCHEMA)
+            self._pid = os.getpid()
+
+        return self._conn
+
+    def prepare_country(self, country):
+        pass
+
+    def has_ip(self, country, ip):
+        return self._db().execute("SELECT 1 FROM sessions WHERE country = ? AND ip = ?", (country, ip)).fetchone() != None
+
+    def _commit_session(self, db, session):
+        cursor = db.execute(
+            "INSERT OR IGNORE INTO sessions (country, ip, isp, modes, started_at) VALUES (?, ?, ?, ?, ?)",
+            (session.country, session.ip, session.isp, json.dumps(session.modes), time.time()),
+        )
+
+        # Another session has recorded the IP
+        if cursor.rowcount == 0:
+            return False
+
+        for mode, responses, records, timings in session.results:
+            self._write_responses(db, session.country, session.ip, mode, responses, records, timings)
+
+        if session.handshakes != None:
+            db.execute(
+                "INSERT OR REPLACE INTO handshakes VALUES (?, ?, ?, ?)",
+                (session.country, session.ip, session.handshakes["full"], session.handshakes["resumed"]),
+            )
+
+        return True
+
+    def _write_responses(self, db, country, ip, mode, responses, records, timings):
+        count = max(len(results) for results in (responses, records, timings) if results != None)
+
+        rows = []
+        for trial in range(count):
+            rows.append((
+                country,
+                ip,
+                "" if mode == None else mode,
+                trial,
+                None if responses == None else responses[trial],
+                None if records == None else json.dumps(records[trial]),
+                None if timings == None else json.dumps(timings[trial]),
+            ))
+
+        db.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def commit_session(self, session):
+        return self._apply([("commit_session", (session,))])[0]
+
+    def apply(self, ops):
+        """Apply the writes of (method name, args) in one transaction, for the writer process.
+        If the transaction fails, each write is retried in its own, so that a failing one never loses the others.
+
+        Returns:
+            The list of the return values, or of the exceptions raised by the failed writes.
+        """
+
+        try:
+            return self._apply(ops)
+
+        except Exception:
+            results = []
+            for op in ops:
+                try:
+                    results.append(self._apply([op])[0])
+
+                except Exception as error:
+                    results.append(error)
+
+            return results
+
+    def _apply(self, ops):
+        # Commit every write at once
+        with self._db() as db:
+            results = [getattr(self, f"_{name}")(db, *args) for name, args in ops]
+
+        if self.counts != None:
+            for (name, args), result in zip(ops, results):
+                if name == "commit_session" and result == True:
+                    self.counts.add(args[0].country, args[0].modes, args[0].ip)
+
+        return results
+
+    def flush(self):
+        pass
+
+    def countries(self):
+        return [row[0] for row in self._db().execute("SELECT DISTINCT country FROM sessions ORDER BY country")]
+
+    def sessions(self, country):
+        yield from self._db().execute("SELECT ip, isp FROM sessions WHERE country = ? ORDER BY started_at", (country,))
+
+    def handshakes(self, country, ip):
+        row = self._db().execute("SELECT full, resumed FROM handshakes WHERE country = ? AND ip = ?", (country, ip)).fetchone()
+        return None if row == None else {"full": row[0], "resumed": row[1]}
+
+    def modes(self, country, ip):
+        return json.loads(self._db().execute("SELECT modes FROM sessions WHERE country = ? AND ip = ?", (country, ip)).fetchone()[0])
+
+    def responses(self, country, ip, mode=None):
+        rows = self._db().execute(
+            "SELECT trial, response, outcome, timing FROM responses WHERE country = ? AND ip = ? AND mode = ? ORDER BY trial",
+            (country, ip, "" if mode == None else mode),
+        )
+
+        for trial, response, record, timing in rows:
+            yield (
+                trial,
+                response,
+                None if record == None else json.loads(record),
+                None if timing == None else json.loads(timing),
+            )
+
+    def close(self):
+        if self._conn != None and self._pid == os.getpid():
+            self._conn.close()
+
+        self._conn = None
+
+
+class QueuedStore:
+    """Hand the writes of pool workers to a single writer process, so that the query loop never waits for the disk.
+    Reads still go to the store directly.
+
+    Args:
+        store: DirectoryStore or SQLiteStore.
+        queue: The queue to the writer process, shared by a manager.
+    """
+
+    def __init__(self, store, queue):
+        self.store = store
+        self._queue = queue
+        self._manager = None
+        self._writer = None
+        self._counters = None
+
+    def __getstate__(self):
+        return {"store": self.store, "queue": self._queue}
+
+    def __setstate__(self, state):
+        self.__init__(state["store"], state["queue"])
+
+    def prepare_country(self, country):
+        self.store.prepare_country(country)
+
+    def has_ip(self, country, ip):
+        return self.store.has_ip(country, ip)
+
+    def commit_session(self, session):
+        """Queue the session, the writer process drops it if the IP has been recorded meanwhile."""
+        self._queue.put(("commit_session", (session,)))
+        return True
+
+    def apply(self, ops):
+        for op in ops:
+            self._queue.put(op)
+
+    def flush(self):
+        """Wait until the writer process has written everything queued."""
+        self._queue.join()
+
+    def counters(self):
+        """Get the counters of the writer process, e.g. for the status line of scheduler.Scheduler.
+
+        Returns:
+            Dictionary of counter names and values.
+        """
+        return {} if self._counters == None else dict(self._counters)
+
+    def countries(self):
+        return self.store.countries()
+
+    def sessions(self, country):
+        return self.store.sessions(country)
+
+    def handshakes(self, country, ip):
+        return self.store.handshakes(country, ip)
+
+    def modes(self, country, ip):
+        return self.store.modes(country, ip)
+
+    def responses(self, country, ip, mode=None):
+        return self.store.responses(country, ip, mode)
+
+    def close(self):
+        """Stop the writer process after writing everything queued."""
+        if self._writer != None:
+            self._queue.put(None)
+            self._writer.join()
+            self._manager.shutdown()
+            self._writer = None
+
+        self.store.close()
+
+
+def _write_loop(store, queue, batch_size, counters):
+    """Write the queued results in batches, until None is queued.
+    The workers have been told that their sessions are recorded, so every write which fails is logged and counted.
+
+    Args:
+        store: DirectoryStore or SQLiteStore.
+        queue: The queue from the workers.
+        batch_size: The maximum number of writes to commit at once.
+        counters: Dictionary shared by a manager, to count the dropped writes and duplicated IPs in.
+    """
+
+    main_logger = logging.getLogger("main")
+    prog_logger = logging.getLogger("main.progress")
+
+    while True:
+        ops = [queue.get()]
+
+        while len(ops) < batch_size:
+            try:
+                ops.append(queue.get_nowait())
+            except Empty:
+                break
+
+        writes = [op for op in ops if op != None]
+
+        try:
+            for (name, args), result in zip(writes, store.apply(writes)):
+                if isinstance(result, Exception):
+                    counters["writes dropped"] = counters.get("writes dropped", 0) + 1
+
+                    if name == "commit_session":
+                        main_logger.error(f"Session dropped by the writer, {args[0].country} {args[0].ip}", exc_info=result)
+                    else:
+                        main_logger.error(f"Write dropped by the writer, {name}", exc_info=result)
+
+                elif name == "commit_session" and result == False:
+                    counters["duplicates dropped"] = counters.get("duplicates dropped", 0) + 1
+                    prog_logger.info(f"Duplicated IP dropped by the writer, {args[0].country} {args[0].ip}")
+
+        except Exception:
+            main_logger.exception("During writing results")
+
+        for _ in ops:
+            queue.task_done()
+
+        if None in ops:
+            store.close()
+            return
+
+
+def start_writer(store, batch_size):
+    """Start the writer process of the store.
+
+    Args:
+        store: DirectoryStore or SQLiteStore.
+        batch_size: The maximum number of writes to commit at once.
+
+    Returns:
+        QueuedStore to pass to the workers.
+    """
+
+    manager = multiprocessing.Manager()
+    queue = manager.JoinableQueue()
+
+    queued = QueuedStore(store, queue)
+    queued._manager = manager
+    queued._counters = manager.dict()
+    queued._writer = multiprocessing.Process(target=_write_loop, args=(store, queue, batch_size, queued._counters), daemon=True)
+    queued._writer.start()
+
+    return queued
+
+
+def open_store(kind, path, counts=None):
+    """Open the result store of the experiment to run, sweeping what crashed runs left behind.
+
+    Args:
+        kind: "files" for one file per query, "sqlite" for a single database.
+        path: The experiment directory.
+        (optional) counts: CollectionCounts to add the committed sessions to, rebuilt from the store if never saved.
+
+    Returns:
+        DirectoryStore or SQLiteStore.
+    """
+
+    if kind == "files":
+        store = DirectoryStore(path, counts)
+        store.sweep()
+    elif kind == "sqlite":
+        store = SQLiteStore(f"{path}/results.db", counts)
+    else:
+        raise ValueError(f"Unknown storage: {kind}")
+
+    if counts != None and not counts.persisted():
+        counts.rebuild(store)
+
+    return store
+
+
+def read_manifest(path):
+    """Read the run state of an experiment saved by write_manifest.
+
+    Args:
+        path: The path of the JSON file.
+
+    Returns:
+        The dictionary of the run state, or None if it has never been saved.
+    """
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as input_file:
+        return json.load(input_file)
+
+
+def write_manifest(path, manifest):
+    """Save the run state of an experiment, replacing the file at once so that a crash never leaves it half-written.
+
+    Args:
+        path: The path of the JSON file.
+        manifest: The dictionary of the run state.
+    """
+
+    with open(f"{path}.tmp", 'w') as output_file:
+        json.dump(manifest, output_file)
+
+    os.replace(f"{path}.tmp", path)
+
+
+def find_store(path):
+    """Open the result store in an existing experiment directory, whichever kind it is, for reading only.
+    Unlike open_store, nothing is swept, as the experiment may still be running.
+
+    Args:
+        path: The experiment directory.
+
+    Returns:
+        DirectoryStore or SQLiteStore.
+    """
+
+    if os.path.exists(f"{path}/results.db"):
+        return SQLiteStore(f"{path}/results.db")
+
+    return DirectoryStore(path)
+
+
+def export(source, target):
+    """Copy every result from a store to another, e.g. from SQLiteStore into DirectoryStore for the original layout.
+
+    Args:
+        source: The store to read.
+        target: The store to write.
+    """
+
+    for country in source.countries():
+        target.prepare_country(country)
+
+        for ip, isp in list(source.sessions(country)):
+            modes = source.modes(country, ip)
+
+            session = SessionBuffer(country, ip)
+            session.write_isp(isp)
+
+            handshakes = source.handshakes(country, ip)
+            if handshakes != None:
+                session.write_handshakes(handshakes["full"], handshakes["resumed"])
+
+            for mode in modes:
+                rows = list(source.responses(country, ip, mode))
+
+                if len(rows) == 0:
+                    continue
+
+                responses = [response for _, response, _, _ in rows]
+                records = [record for _, _, record, _ in rows]
+                timings = [timing for _, _, _, timing in rows]
+
+                session.write_responses(
+                    mode,
+                    None if None in responses else responses,
+                    None if None in records else records,
+                    None if None in timings else timings,
+                )
+
+            target.commit_session(session)